@@ -0,0 +1,276 @@
+import argparse
+import json
+import math
+import os
+import tempfile
+import time
+
+import h5py
+import networkx as nx
+import numpy as np
+from shapely.geometry import LineString
+from shapely.ops import substring
+
+import load_dataset
+from create_data_samples import SAMPLE_KEYS, retrieve_kinemetic_data_and_gt, retrieve_kinemetic_data_and_gt_batch
+from create_route import create_map, get_areas_between_routes_and_gt
+from osm_wrapper import LinkStore, OSMWrapper, graph_to_arrays, links_from_arrays
+from tree import Tree
+from utils import latlon_to_vehicle_coordinates, links_to_vehicle_coordinates, transform_to_vehicle_coordinates
+
+# center of the synthetic networks, every network has a road going east through it
+LAT0 = 51.1
+LON0 = 17.0
+METERS_PER_DEG_LAT = 111320.0
+METERS_PER_DEG_LON = METERS_PER_DEG_LAT * math.cos(math.radians(LAT0))
+
+
+class SyntheticNetwork:
+    def __init__(self, name: str):
+        """Builds a road network in local meters (north, east) around (LAT0, LON0) as an osmnx-like graph."""
+        self.name = name
+        self.graph = nx.MultiDiGraph(crs="epsg:4326")
+
+    def add_node(self, node_id: int, north_m: float, east_m: float):
+        self.graph.add_node(node_id, y=LAT0 + north_m / METERS_PER_DEG_LAT, x=LON0 + east_m / METERS_PER_DEG_LON)
+
+    def add_road(self, node_a: int, node_b: int, highway="residential", lanes="1", maxspeed="50", oneway=False):
+        a = self.graph.nodes[node_a]
+        b = self.graph.nodes[node_b]
+        length = math.hypot((a["y"] - b["y"]) * METERS_PER_DEG_LAT, (a["x"] - b["x"]) * METERS_PER_DEG_LON)
+        data = {"highway": highway, "lanes": lanes, "maxspeed": maxspeed, "length": length}
+        self.graph.add_edge(node_a, node_b, **data)
+        if not oneway:
+            self.graph.add_edge(node_b, node_a, **data)
+
+
+def grid_network(size: int, extent_m=600.0) -> SyntheticNetwork:
+    """size x size intersections of two-way streets covering extent_m x extent_m."""
+    network = SyntheticNetwork("grid")
+    spacing = extent_m / (size - 1)
+    for i in range(size):
+        for j in range(size):
+            network.add_node(i * size + j, (i - size // 2) * spacing, (j - size // 2) * spacing)
+    for i in range(size):
+        for j in range(size):
+            if j + 1 < size:
+                network.add_road(i * size + j, i * size + j + 1, "primary" if i == size // 2 else "residential")
+            if i + 1 < size:
+                network.add_road(i * size + j, (i + 1) * size + j)
+    return network
+
+
+def highway_network(size: int, extent_m=600.0) -> SyntheticNetwork:
+    """A motorway with size segments and a frontage road on each side, connected by ramps at every node."""
+    network = SyntheticNetwork("highway")
+    spacing = extent_m / size
+    for j in range(size + 1):
+        east_m = (j - size / 2) * spacing
+        for row, north_m in enumerate([0.0, 40.0, -40.0]):
+            network.add_node(row * (size + 1) + j, north_m, east_m)
+    for j in range(size + 1):
+        for row in range(3):
+            node = row * (size + 1) + j
+            if j < size:
+                network.add_road(node, node + 1, "motorway" if row == 0 else "residential", "3" if row == 0 else "1")
+            if row > 0:
+                network.add_road(j, node, "motorway_link")
+    return network
+
+
+def roundabout_network(size: int, extent_m=600.0, radius_m=12.0) -> SyntheticNetwork:
+    """A grid of size x size roundabouts, each a one-way ring of four nodes, connected by two-way streets."""
+    network = SyntheticNetwork("roundabout")
+    spacing = extent_m / (size - 1)
+    # north, east, south, west node of every ring
+    offsets = [(radius_m, 0.0), (0.0, radius_m), (-radius_m, 0.0), (0.0, -radius_m)]
+    for i in range(size):
+        for j in range(size):
+            center = 4 * (i * size + j)
+            for k, (north_m, east_m) in enumerate(offsets):
+                network.add_node(center + k, (i - size // 2) * spacing + north_m, (j - size // 2) * spacing + east_m)
+            for k in range(4):
+                # counterclockwise seen from above
+                network.add_road(center + k, center + (k - 1) % 4, oneway=True)
+    for i in range(size):
+        for j in range(size):
+            center = 4 * (i * size + j)
+            if j + 1 < size:
+                network.add_road(center + 1, center + 4 + 3)
+            if i + 1 < size:
+                network.add_road(center, center + 4 * size + 2)
+    return network
+
+
+TOPOLOGIES = {"grid": grid_network, "highway": highway_network, "roundabout": roundabout_network}
+
+
+class SyntheticOSMWrapper(OSMWrapper):
+    def __init__(self, network: SyntheticNetwork):
+        """OSMWrapper answering every query from the synthetic network, no map file or network access is needed."""
+        super().__init__()
+        self.store = LinkStore(links_from_arrays(graph_to_arrays(network.graph)))
+
+
+def write_scenes(file_name: str, num_samples: int, frames=1500, speed=15.0, seed=0):
+    """
+    Writes samples with the lcm_data schema of the recordings and some data the pipeline never reads. The ego
+    vehicle drives east through the center of the networks at speed m/s, logged at 50 Hz.
+    """
+    rng = np.random.default_rng(seed)
+    with h5py.File(file_name, "w") as f:
+        for k in range(num_samples):
+            sample = f.create_group(f"sample_{k}")
+            for key in ["FC_ant_tlc_data_image_raw_path_kw", "frame_timestamp_date", "suite_id", "vehicle", "route"]:
+                sample.attrs[key] = f"{key}_{k}"
+            sample.attrs["sequence_id"] = f"synthetic_{k}"
+            lcm_data = sample.create_group("lcm_data")
+            # centered on the network, with some lateral offset to the road
+            east_m = (np.arange(frames) - frames / 2) * speed / 50
+            north_m = np.full(frames, rng.uniform(-2.0, 2.0))
+            lcm_data["oxts_lat"] = LAT0 + north_m / METERS_PER_DEG_LAT
+            lcm_data["oxts_lon"] = LON0 + east_m / METERS_PER_DEG_LON
+            lcm_data["oxts_heading"] = rng.normal(size=frames) * 0.1
+            lcm_data["oxts_valid"] = np.ones(frames)
+            lcm_data["lcm_egomotion_timestamp"] = 1e12 + np.arange(frames) * 20000.0
+            for key in ["lcm_lat_acceleration", "lcm_lat_velocity", "lcm_lon_acceleration", "lcm_lon_velocity"]:
+                lcm_data[key] = rng.normal(size=frames)
+            lcm_data["lcm_yaw_rate"] = rng.normal(size=frames) * 0.01
+            lcm_data["lcm_lat_quality"] = np.full(frames, 3)
+            lcm_data["lcm_lon_quality"] = np.full(frames, 3)
+            # recordings contain much more than the pipeline reads
+            for key in ["lcm_steering_angle", "lcm_wheel_speed", "oxts_altitude", "oxts_pitch", "oxts_roll"]:
+                lcm_data[key] = rng.normal(size=frames)
+            sample["ground_truth_data/holistic_path"] = rng.normal(size=(frames, 32))
+
+
+def time_call(func, setup=None, repeat=5) -> dict:
+    """Times func(setup()) repeat times, setup is not timed. Returns the minimum and median in seconds."""
+    durations = []
+    for _ in range(repeat):
+        state = setup() if setup is not None else None
+        start = time.perf_counter()
+        func(state)
+        durations.append(time.perf_counter() - start)
+    return {"min": min(durations), "median": float(np.median(durations))}
+
+
+def benchmark_network(network: SyntheticNetwork, sample: dict, repeat: int) -> dict:
+    """Times the route search functions on one network for the ego pose and ground truth of sample."""
+    wrapper = SyntheticOSMWrapper(network)
+    data_out = retrieve_kinemetic_data_and_gt(sample)
+    lat, lon = data_out["pred_time"]["lat"], data_out["pred_time"]["lon"]
+    vehicle_data = {"ego_vehicle_lat": lat, "ego_vehicle_lon": lon, "ego_vehicle_yaw": data_out["pred_time"]["heading"]}
+    map_links = create_map(lat, lon, wrapper)
+    links = wrapper.links
+    gt_coords = np.stack([data_out["gt"]["local_lat"], data_out["gt"]["local_lon"]], axis=1)
+    gt_line = substring(LineString(gt_coords), 0, 200)
+
+    def tree_with_start_points(_=None):
+        tree = Tree(map_links, wrapper, vehicle_data)
+        tree.insert_start_points(10)
+        return tree
+
+    tree = tree_with_start_points()
+    tree.find_possible_routes(max_routes=20000, max_expansions=2000000)
+    # all candidate routes, scored at once like find_best_route does
+    route_coords, route_offsets = tree.get_routes_as_coords()
+    coords = np.concatenate([np.asarray(link.get_geometry().coords) for link in links])
+
+    results = {"num_links": len(links), "num_routes": len(tree.routes)}
+    results["timings"] = {
+        "create_map": time_call(lambda _: create_map(lat, lon, wrapper), repeat=repeat),
+        "Tree.__init__": time_call(lambda _: Tree(map_links, wrapper, vehicle_data), repeat=repeat),
+        "insert_start_points": time_call(
+            lambda tree: tree.insert_start_points(10), lambda: Tree(map_links, wrapper, vehicle_data), repeat
+        ),
+        "find_possible_routes": time_call(
+            lambda tree: tree.find_possible_routes(max_routes=20000, max_expansions=2000000),
+            tree_with_start_points,
+            repeat,
+        ),
+        "get_areas_between_routes_and_gt": time_call(
+            lambda _: get_areas_between_routes_and_gt(route_coords, route_offsets, gt_line), repeat=repeat
+        ),
+        "latlon_to_vehicle_coordinates": time_call(
+            lambda _: latlon_to_vehicle_coordinates(coords, lat, lon, vehicle_data["ego_vehicle_yaw"]), repeat=repeat
+        ),
+        "transform_to_vehicle_coordinates": time_call(
+            lambda _: [transform_to_vehicle_coordinates(vehicle_data, link) for link in links], repeat=repeat
+        ),
+        "links_to_vehicle_coordinates": time_call(
+            lambda _: links_to_vehicle_coordinates(links, vehicle_data), repeat=repeat
+        ),
+    }
+    return results
+
+
+def benchmark_loading(file_name: str, repeat: int) -> dict:
+    """
+    Times reading one sample of the synthetic scenes, completely and only the keys used by the pipeline, and the
+    kinematics extraction of all samples one by one and as a batch.
+    """
+    with load_dataset.DatasetFile(file_name) as df:
+        scenes = [data for _, data in df.iter_samples(keys_to_extract=SAMPLE_KEYS)]
+    with h5py.File(file_name, "r") as f:
+        sample_id = next(iter(f.keys()))
+        return {
+            "load_recursively": time_call(lambda _: load_dataset.load_recursively(f[sample_id]), repeat=repeat),
+            "load_recursively[SAMPLE_KEYS]": time_call(
+                lambda _: load_dataset.load_recursively(f[sample_id], SAMPLE_KEYS), repeat=repeat
+            ),
+            f"retrieve_kinematics x{len(scenes)}": time_call(
+                lambda _: [retrieve_kinemetic_data_and_gt(scene) for scene in scenes], repeat=repeat
+            ),
+            f"retrieve_kinematics_batch x{len(scenes)}": time_call(
+                lambda _: retrieve_kinemetic_data_and_gt_batch(scenes), repeat=repeat
+            ),
+        }
+
+
+def print_results(results: dict):
+    for topology, runs in results["networks"].items():
+        print(f"\n{topology}")
+        functions = list(runs[0]["timings"])
+        header = f"{'size':>6} {'links':>7} {'routes':>7} " + " ".join(f"{name[:22]:>22}" for name in functions)
+        print(header)
+        for run in runs:
+            row = f"{run['size']:>6} {run['num_links']:>7} {run['num_routes']:>7} "
+            row += " ".join(f"{run['timings'][name]['median'] * 1000:>19.3f} ms" for name in functions)
+            print(row)
+    print("\nloading")
+    for name, timing in results["loading"].items():
+        print(f"{name:<30} {timing['median'] * 1000:.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing on synthetic road networks and scenes.")
+    parser.add_argument(
+        "--topologies", nargs="+", default=list(TOPOLOGIES), choices=list(TOPOLOGIES), help="Road networks to use."
+    )
+    parser.add_argument(
+        "--sizes", nargs="+", type=int, default=[6, 11, 21], help="Network sizes, intersections (or segments) per side."
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per function, the median is reported.")
+    parser.add_argument("--json", type=str, default=None, help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    results = {"networks": {}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scene_file = os.path.join(tmp_dir, "scenes.hdf5")
+        write_scenes(scene_file, num_samples=4)
+        with load_dataset.DatasetFile(scene_file) as df:
+            sample = next(df.iter_samples(keys_to_extract=SAMPLE_KEYS))[1]
+        results["loading"] = benchmark_loading(scene_file, args.repeat)
+
+    for topology in args.topologies:
+        results["networks"][topology] = []
+        for size in args.sizes:
+            run = benchmark_network(TOPOLOGIES[topology](size), sample, args.repeat)
+            run["size"] = size
+            results["networks"][topology].append(run)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
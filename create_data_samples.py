@@ -1,140 +1,236 @@
 import argparse
+import hashlib
+import json
 import sys
+import time
 import os
 import pickle
+import shutil
 import traceback
+import warnings
 import h5py
+from itertools import groupby
+from math import ceil, floor
 from multiprocessing import Pool
+from multiprocessing.util import Finalize
 
 import numpy as np
 from tqdm import tqdm
 
-from create_route import create_route
+from create_route import create_route, create_routes, get_map_rectangle, get_sequence_map_rectangle
 import load_dataset
 
+from map_cache import CachedOSMWrapper
 from osm_wrapper import OSMWrapper
-from utils import global_to_vehicle_coordinates
-
-
-def retrieve_kinemetic_data_and_gt(scene_data):
-    out_dict = {}
+from prefetch import MapPrefetcher
+from manifest import RunManifest
+from shared_map import SharedLinkStore, SharedMap, map_arrays_from_file
+from route_shards import ShardWriter, build_index, list_shards, read_shard_sequence_ids
+from timing import timer, write_report
+from utils import latlon_to_vehicle_coordinates, latlon_to_vehicle_coordinates_per_pose
+
+
+# bump when the produced samples change, so a rerun processes all samples again
+PIPELINE_VERSION = 2
+# outcome of a sample, in the order the worker returns the counters
+OUTCOMES = [
+    "count",
+    "no_lcm_data",
+    "incomplete_lcm_data",
+    "not_valid",
+    "already_exists",
+    "short_gt",
+    "no_routes_close_by",
+    "other_route_errors",
+]
+KINEMATIC_KEYS = [
+    "lcm_egomotion_timestamp",
+    "oxts_heading",
+    "oxts_lat",
+    "oxts_lon",
+    "lcm_lat_acceleration",
+    "lcm_lat_velocity",
+    "lcm_lon_acceleration",
+    "lcm_lon_velocity",
+    "lcm_yaw_rate",
+]
+META_KEYS = [
+    "FC_ant_tlc_data_image_raw_path_kw",
+    "frame_timestamp_date",
+    "sequence_id",
+    "suite_id",
+    "vehicle",
+    "route",
+]
+# everything retrieve_kinemetic_data_and_gt reads, the rest of a sample is never loaded
+SAMPLE_KEYS = KINEMATIC_KEYS + META_KEYS + ["oxts_valid", "lcm*quality*"]
+LOGS_PER_SECOND = 50
+# oxts frames between two kinematic samples
+STEP_SIZE = 5
+OBSERVATION_WINDOW = 3  # seconds
+# m, create_route rejects prediction times with a shorter ground truth
+MIN_GT_LENGTH = 200
+
+
+def is_valid(lcm_data: dict) -> bool:
+    """Whether all lcm quality signals are 3 and all oxts data is valid over the whole sample."""
+    for key, value in lcm_data.items():
+        if key.startswith("lcm") and "quality" in key and np.min(value) != 3:
+            return False  # lcm data not valid
+    return np.min(lcm_data["oxts_valid"]) == 1  # oxts data valid
+
+
+def get_remaining_distances(oxts_lat, oxts_lon) -> np.ndarray:
+    """Distance in m driven from every oxts frame to the last one, the length of the ground truth of each frame."""
+    oxts_lat = np.asarray(oxts_lat, dtype=np.float64)
+    oxts_lon = np.asarray(oxts_lon, dtype=np.float64)
+    if len(oxts_lat) == 0:
+        return np.zeros(0)
+    points = latlon_to_vehicle_coordinates(np.stack([oxts_lat, oxts_lon], axis=1), oxts_lat[0], oxts_lon[0], 0)
+    steps = np.hypot(*np.diff(points, axis=0).T)
+    return np.concatenate([np.cumsum(steps[::-1])[::-1], [0.0]])
+
+
+def get_prediction_frames(lcm_data: dict, stride: int = 0) -> list[int]:
+    """
+    Oxts frames used as prediction times of a sequence. The middle frame, and with a stride every stride-th frame
+    before and after it that has a full observation window and at least MIN_GT_LENGTH m of ground truth. The middle
+    frame is always used, like without a stride, even if it has neither.
+    """
+    middle_frame = int(len(lcm_data["oxts_heading"]) / 2)
+    if stride <= 0:
+        return [middle_frame]
+    first_frame = OBSERVATION_WINDOW * LOGS_PER_SECOND
+    # the distance left only shrinks, later frames could only end as short_gt
+    remaining = get_remaining_distances(lcm_data["oxts_lat"], lcm_data["oxts_lon"])
+    last_frame = int(np.count_nonzero(remaining >= MIN_GT_LENGTH)) - 1
+    before = range(middle_frame - stride, first_frame - 1, -stride)
+    after = range(middle_frame + stride, last_frame + 1, stride)
+    return list(reversed(before)) + [middle_frame] + list(after)
+
+
+def get_relative_time(timestamps, reference_index: int) -> np.ndarray:
+    """
+    Timestamps relative to timestamps[reference_index] as float64. They are subtracted in their own dtype first, so
+    large integer timestamps, e.g. nanoseconds since the epoch, stay exact.
+    """
+    timestamps = np.asarray(timestamps)
+    if timestamps.dtype.kind == "u":
+        # earlier timestamps would wrap around
+        timestamps = timestamps.astype(np.int64)
+    return (timestamps - timestamps[reference_index]).astype(np.float64)
+
+
+def extract_kinematics_and_gt(scene_data, prediction_frame: int = None) -> dict:
+    """
+    Cuts the observation window and the ground truth out of a sample, positions are still in latitude, longitude.
+    All signals become float64 arrays, timestamps only once they are relative.
+    :param prediction_frame: Oxts frame of the prediction time, the middle frame if None
+    """
     lcm_data = scene_data["lcm_data"]
-    kinematic_keys = [
-        "lcm_egomotion_timestamp",
-        "oxts_heading",
-        "oxts_lat",
-        "oxts_lon",
-        "lcm_lat_acceleration",
-        "lcm_lat_velocity",
-        "lcm_lon_acceleration",
-        "lcm_lon_velocity",
-        "lcm_yaw_rate",
-    ]
-    ground_truth_keys = [key for key in lcm_data.keys() if key in ["oxts_lat", "oxts_lon", "lcm_egomotion_timestamp"]]
-    quality_keys = [key for key in lcm_data.keys() if key.startswith("lcm") and "quality" in key]
-
-    quality_dict = {key: value for key, value in lcm_data.items() if key in quality_keys}
-    if not all([min(value) == 3 for value in quality_dict.values()]):
-        raise ValueError("Data not valid")  # lcm data not valid
-
-    if min(lcm_data["oxts_valid"]) != 1:
-        raise ValueError("Data not valid")  # oxts data not valid
+    if not is_valid(lcm_data):
+        raise ValueError("Data not valid")
 
     len_oxts = len(lcm_data["oxts_heading"])
-    middle_frame = int(len_oxts / 2)
-    logs_per_second = 50
-    step_size = 5
+    middle_frame = int(len_oxts / 2) if prediction_frame is None else prediction_frame
     # future_horizon = 5  # seconds
-    observation_window = 3  # seconds
-    start_index = int(middle_frame - observation_window * logs_per_second)
-    # end_index = int(middle_frame + future_horizon * logs_per_second + step_size)
+    start_index = int(middle_frame - OBSERVATION_WINDOW * LOGS_PER_SECOND)
+    # end_index = int(middle_frame + future_horizon * LOGS_PER_SECOND + STEP_SIZE)
 
+    out_dict = {}
     out_dict["pred_time"] = {
         "lat": lcm_data["oxts_lat"][middle_frame],
         "lon": lcm_data["oxts_lon"][middle_frame],
         "heading": lcm_data["oxts_heading"][middle_frame],
     }
-    kinematic_data = {
-        key: value[start_index : middle_frame + 1 : step_size]
-        for key, value in lcm_data.items()
-        if key in kinematic_keys
-    }
-    kinematic_data["relative_time"] = [
-        i - kinematic_data["lcm_egomotion_timestamp"][-1] for i in kinematic_data["lcm_egomotion_timestamp"]
-    ]
-    kinematic_data.pop("lcm_egomotion_timestamp")
-    ground_truth_data = {key: value[middle_frame:] for key, value in lcm_data.items() if key in ground_truth_keys}
-    ground_truth_data["relative_time"] = [
-        i - ground_truth_data["lcm_egomotion_timestamp"][0] for i in ground_truth_data["lcm_egomotion_timestamp"]
-    ]
-    ground_truth_data.pop("lcm_egomotion_timestamp")
+    kinematic_data = {}
+    for key, value in lcm_data.items():
+        if key in KINEMATIC_KEYS:
+            value = np.asarray(value)[start_index : middle_frame + 1 : STEP_SIZE]
+            kinematic_data[key] = value if key == "lcm_egomotion_timestamp" else value.astype(np.float64)
+    kinematic_data["relative_time"] = get_relative_time(kinematic_data.pop("lcm_egomotion_timestamp"), -1)
+    # make heading relative to the ego vehicle
+    kinematic_data["oxts_heading"] = kinematic_data["oxts_heading"] - out_dict["pred_time"]["heading"]
+
+    ground_truth_data = {}
+    for key in ["oxts_lat", "oxts_lon"]:
+        if key in lcm_data:
+            ground_truth_data[key] = np.asarray(lcm_data[key][middle_frame:], dtype=np.float64)
+    ground_truth_data["relative_time"] = get_relative_time(lcm_data["lcm_egomotion_timestamp"][middle_frame:], 0)
 
     out_dict["kinematics"] = kinematic_data
     out_dict["gt"] = ground_truth_data
-
-    meta_keys = [
-        "FC_ant_tlc_data_image_raw_path_kw",
-        "frame_timestamp_date",
-        "sequence_id",
-        "suite_id",
-        "vehicle",
-        "route",
-    ]
-    for key in meta_keys:
+    for key in META_KEYS:
         out_dict[key] = scene_data[key]
+    return out_dict
 
-    # MAKE THINGS RELATIVE TO THE EGO VEHICLE
-    relative_gt = global_to_vehicle_coordinates(
-        np.vstack([out_dict["gt"]["oxts_lat"], out_dict["gt"]["oxts_lon"]]).T,
-        [out_dict["pred_time"]["lat"], out_dict["pred_time"]["lon"]],
-        out_dict["pred_time"]["heading"],
+
+def get_global_points(out_dict: dict) -> np.ndarray:
+    """Ground truth followed by the observed positions as one (N, 2) latitude, longitude array."""
+    return np.concatenate(
+        [
+            np.stack([out_dict["gt"]["oxts_lat"], out_dict["gt"]["oxts_lon"]], axis=1),
+            np.stack([out_dict["kinematics"]["oxts_lat"], out_dict["kinematics"]["oxts_lon"]], axis=1),
+        ]
     )
-    out_dict["gt"]["local_lat"] = relative_gt[:, 0].tolist()
-    out_dict["gt"]["local_lon"] = relative_gt[:, 1].tolist()
+
+
+def set_local_points(out_dict: dict, local_points: np.ndarray):
+    """Replaces the positions of get_global_points by their coordinates relative to the ego vehicle."""
+    num_gt = len(out_dict["gt"]["oxts_lat"])
+    out_dict["gt"]["local_lat"] = local_points[:num_gt, 0]
+    out_dict["gt"]["local_lon"] = local_points[:num_gt, 1]
     out_dict["gt"].pop("oxts_lat")
     out_dict["gt"].pop("oxts_lon")
+    out_dict["kinematics"]["oxts_lat"] = local_points[num_gt:, 0]
+    out_dict["kinematics"]["oxts_lon"] = local_points[num_gt:, 1]
 
-    kin = np.vstack([out_dict["kinematics"]["oxts_lat"], out_dict["kinematics"]["oxts_lon"]]).T
-    # kin = [[out_dict["kinematics"]["oxts_lat"][i], out_dict["kinematics"]["oxts_lon"][i]] for i in range(len(out_dict["kinematics"]["oxts_lat"]))]
-    kin_local_coords = global_to_vehicle_coordinates(
-        kin,
-        [out_dict["pred_time"]["lat"], out_dict["pred_time"]["lon"]],
-        out_dict["pred_time"]["heading"],
-    )
-    out_dict["kinematics"]["oxts_lat"] = kin_local_coords[:, 0].tolist()
-    out_dict["kinematics"]["oxts_lon"] = kin_local_coords[:, 1].tolist()
 
-    # make heading relative to the ego vehicle
-    out_dict["kinematics"]["oxts_heading"] = [
-        heading - out_dict["pred_time"]["heading"] for heading in out_dict["kinematics"]["oxts_heading"]
-    ]
+def retrieve_kinemetic_data_and_gt(scene_data, prediction_frame: int = None):
+    out_dict = extract_kinematics_and_gt(scene_data, prediction_frame)
 
-    # make sure that the keys are valid
+    # MAKE THINGS RELATIVE TO THE EGO VEHICLE
+    local_points = latlon_to_vehicle_coordinates(
+        get_global_points(out_dict),
+        out_dict["pred_time"]["lat"],
+        out_dict["pred_time"]["lon"],
+        out_dict["pred_time"]["heading"],
+    )
+    set_local_points(out_dict, local_points)
     return out_dict
 
 
-def load_recursively(hdf_obj, keys_to_extract: list = []):
-    data = {}
-    # Extract attributes
-    for name, attr_data in hdf_obj.attrs.items():
-        if not keys_to_extract or name in keys_to_extract:
-            data[name] = attr_data
-    for key in hdf_obj.keys():
-        # print(f"Key: {key}")  # Print the key
-        if isinstance(hdf_obj[key], h5py.Group):
-            # Extract everything in the group
-            data[key] = load_recursively(hdf_obj[key], keys_to_extract)
-            if not data[key]:
-                data.pop(key)
-        if isinstance(hdf_obj[key], h5py.Dataset):
-            if not keys_to_extract or key in keys_to_extract:
-                save_data = hdf_obj[key][()]
-                if isinstance(save_data, np.ndarray):
-                    data[key] = save_data.tolist()
-                else:
-                    data[key] = save_data
-
-    return data
+def retrieve_kinemetic_data_and_gt_batch(scenes: list[dict], prediction_frames: list[int] = None) -> list:
+    """
+    retrieve_kinemetic_data_and_gt for many samples, e.g. all samples of a file or several prediction times of one
+    sample, with one coordinate transform for all of them. Returns the output of every sample, or the ValueError it
+    raised.
+    :param prediction_frames: Prediction frame of every sample, None for the middle frames
+    """
+    if prediction_frames is None:
+        prediction_frames = [None] * len(scenes)
+    outputs = []
+    for scene_data, prediction_frame in zip(scenes, prediction_frames):
+        try:
+            outputs.append(extract_kinematics_and_gt(scene_data, prediction_frame))
+        except ValueError as e:
+            outputs.append(e)
+    valid = [out_dict for out_dict in outputs if isinstance(out_dict, dict)]
+    if not valid:
+        return outputs
+
+    points = [get_global_points(out_dict) for out_dict in valid]
+    sizes = [len(sample_points) for sample_points in points]
+    local_points = latlon_to_vehicle_coordinates_per_pose(
+        np.concatenate(points),
+        np.repeat(np.arange(len(valid)), sizes),
+        [out_dict["pred_time"]["lat"] for out_dict in valid],
+        [out_dict["pred_time"]["lon"] for out_dict in valid],
+        [out_dict["pred_time"]["heading"] for out_dict in valid],
+    )
+    for out_dict, sample_points in zip(valid, np.split(local_points, np.cumsum(sizes)[:-1])):
+        set_local_points(out_dict, sample_points)
+    return outputs
 
 
 def writer(filename, data):
@@ -142,81 +238,316 @@ def writer(filename, data):
         pickle.dump(data, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
 
-def worker(worker_data):
+_wrapper = None
+# arrays of --map_file in shared memory, set in every worker by set_shared_map
+shared_map_spec = None
 
-    file_name, worker_id = worker_data
-    # print(f"worker {worker_id} started processing {file_name}")
 
-    wrapper = OSMWrapper()
+def set_shared_map(spec: dict):
+    global shared_map_spec
+    shared_map_spec = spec
 
-    df = load_dataset.DatasetFile(file_name)
-    group_information = df.get_file_information()
-
-    count = 0
-    already_exists = 0
-    no_lcm_data = 0
-    incomplete_lcm_data = 0
-    not_valid = 0
-    short_gt = 0
-    no_routes_close_by = 0
-    other_route_errors = 0
-    for data_point in group_information["groups"]:
-
-        # 1. Load sample with data
-        data = df.load_sample(data_point)
-
-        data = dict(ele for sub in data.values() for ele in sub.items())
-        if data["sequence_id"] + ".pkl" in existing_files:
-            print(f"worker {worker_id} skipped {data['sequence_id']}, already exists")
-            already_exists += 1
-            continue
-        if "lcm_data" not in data:
-            no_lcm_data += 1
-            continue
-        if "lcm_lat_acceleration" not in data["lcm_data"]:
-            print(f"worker {worker_id} skipped {data['sequence_id']}, lcm data contains only oxts data")
-            incomplete_lcm_data += 1
-            continue
 
-        # 2. Create a data_out dictionary and add kinematics and ground truth to it
-        try:
-            data_out = retrieve_kinemetic_data_and_gt(data)
-        except ValueError as e:
-            if "not valid" in str(e):
-                not_valid += 1
-                continue
+def init_process(spec: dict):
+    """Sets up a worker process, and the main process for --debug."""
+    # osmnx warns on every query, the filter is process-wide and can't be set per query from prefetch threads
+    warnings.simplefilter("ignore", FutureWarning)
+    set_shared_map(spec)
+
+
+def get_wrapper():
+    """Returns the OSMWrapper of this process, so a local map file is loaded only once per process."""
+    global _wrapper
+    if _wrapper is None:
+        if shared_map_spec is not None:
+            # attached once per process, the arrays are never copied
+            _wrapper = OSMWrapper(store=SharedLinkStore(SharedMap.attach(shared_map_spec)))
+        elif map_file is None and map_cache is not None:
+            _wrapper = CachedOSMWrapper(map_cache)
+        else:
+            _wrapper = OSMWrapper(map_file)
+    return _wrapper
+
+
+_manifest = None
+
+
+def get_manifest() -> RunManifest:
+    """Returns the RunManifest of this process, every process appends to its own manifest file."""
+    global _manifest
+    if _manifest is None:
+        _manifest = RunManifest(manifest_dir, run_version)
+    return _manifest
+
+
+_shard_writer = None
+# manifest entries of written samples by sequence_id in the order they were written, recorded once the shard
+# holding them is finalized. A sequence_id can be written more than once, every row of a shard records one entry
+_unrecorded: dict[str, list[tuple]] = {}
+
 
+def record_finalized(sequence_ids: list[str]):
+    manifest = get_manifest()
+    for sequence_id in sequence_ids:
+        entries = _unrecorded[sequence_id]
+        manifest.record(*entries.pop(0))
+        if not entries:
+            del _unrecorded[sequence_id]
+
+
+def get_shard_writer() -> ShardWriter:
+    """
+    Returns the ShardWriter of this process, shards fill up over all batches of a worker instead of one batch.
+    The last shard is finalized when the process exits, pool workers exit once the pool is closed and joined.
+    """
+    global _shard_writer
+    if _shard_writer is None:
+        _shard_writer = ShardWriter(
+            output, max_samples=shard_size, compression=shard_compression, on_flush=record_finalized
+        )
+        Finalize(None, close_shard_writer, exitpriority=10)
+    return _shard_writer
+
+
+def close_shard_writer():
+    if _shard_writer is not None:
+        with timer.stage("write"):
+            _shard_writer.close()
+
+
+def get_run_version() -> str:
+    """Code and config version of this run, samples are only skipped if they were processed with the same one."""
+    config = {
+        "map_file": os.path.basename(map_file) if map_file else None,
+        "max_routes": max_routes,
+        "max_route_expansions": max_route_expansions,
+        "scoring_step": scoring_step,
+    }
+    if prediction_stride > 0:
+        # not part of the config by default, so runs without a stride keep their version
+        config["prediction_stride"] = prediction_stride
+    config_hash = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:8]
+    return f"{PIPELINE_VERSION}-{config_hash}"
+
+
+def get_cache_stats(wrapper) -> dict:
+    if isinstance(wrapper, CachedOSMWrapper):
+        return wrapper.cache.get_stats()
+    return {"memory_hits": 0, "disk_hits": 0, "misses": 0, "fetch_time": 0.0}
+
+
+def list_samples(file_name: str) -> list[tuple[str, str]]:
+    """Returns (file_name, sample_id) for every sample in the file."""
+    df = load_dataset.DatasetFile(file_name)
+    return [(file_name, sample_id) for sample_id in df.get_file_information()["groups"]]
+
+
+def region_key(sample_group: h5py.Group, tile_size_deg: float):
+    """Tile of the prediction position of a sample, None if the sample has no position."""
+    if "lcm_data" not in sample_group or "oxts_lat" not in sample_group["lcm_data"]:
+        return None
+    oxts_lat = sample_group["lcm_data"]["oxts_lat"]
+    oxts_lon = sample_group["lcm_data"]["oxts_lon"]
+    # same frame as retrieve_kinemetic_data_and_gt uses as prediction time
+    middle_frame = int(len(oxts_lat) / 2)
+    return floor(oxts_lat[middle_frame] / tile_size_deg), floor(oxts_lon[middle_frame] / tile_size_deg)
+
+
+def order_by_region(file_names: list[str], tile_size_deg: float) -> list[tuple[str, str]]:
+    """
+    Returns the samples of all files ordered tile by tile, only the prediction position of each sample is read.
+    Consecutive samples are close to each other, so a batch covers one or a few neighbouring tiles and the map data
+    a worker loads is reused within the batch.
+    """
+    tiles = {}
+    for file_name in file_names:
+        with h5py.File(file_name, "r") as f:
+            for sample_id in f.keys():
+                key = region_key(f[sample_id], tile_size_deg)
+                tiles.setdefault(key, []).append((file_name, sample_id))
+
+    # samples without a position are skipped by the worker anyway, they go last
+    ordered_keys = sorted(key for key in tiles if key is not None) + ([None] if None in tiles else [])
+    return [sample for key in ordered_keys for sample in tiles[key]]
+
+
+def make_batches(samples: list, num_workers: int, max_batch_size: int, min_batch_size: int = 1) -> list[list]:
+    """
+    Splits the samples into consecutive batches of decreasing size (guided scheduling). Each batch is a share of
+    the remaining samples, so workers start on large batches and the small batches at the end keep all workers busy
+    until the last sample, no matter which samples are slow.
+    """
+    batches = []
+    start = 0
+    while start < len(samples):
+        size = ceil((len(samples) - start) / (2 * num_workers))
+        size = min(max(size, min_batch_size), max_batch_size)
+        batches.append(samples[start : start + size])
+        start += size
+    return batches
+
+
+def get_prediction_area(data: dict, wrapper):
+    """Map area create_route or create_routes will request for the sample, None if the sample is skipped before."""
+    lcm_data = data.get("lcm_data", {})
+    if "lcm_lat_acceleration" not in lcm_data or "oxts_heading" not in lcm_data:
+        return None
+    if "oxts_valid" not in lcm_data or not is_valid(lcm_data):
+        return None
+    # same frames as process_sample routes, existing ones are skipped
+    frames = get_prediction_frames(lcm_data, prediction_stride)
+    if prediction_stride <= 0:
+        if data["sequence_id"] in existing_sequence_ids:
+            return None
+        return get_map_rectangle(lcm_data["oxts_lat"][frames[0]], lcm_data["oxts_lon"][frames[0]], wrapper)
+    frames = [frame for frame in frames if f"{data['sequence_id']}_{frame}" not in existing_sequence_ids]
+    if not frames:
+        return None
+    positions = [(lcm_data["oxts_lat"][frame], lcm_data["oxts_lon"][frame]) for frame in frames]
+    return get_sequence_map_rectangle(positions, wrapper)
+
+
+def iter_batch(samples: list[tuple[str, str]]):
+    """
+    Lazily yields (file_name, sample_id, data) for (file_name, sample_id) pairs. One handle is kept open for
+    consecutive samples of the same file and only SAMPLE_KEYS are read.
+    """
+    for file_name, file_samples in groupby(samples, key=lambda sample: sample[0]):
+        with load_dataset.DatasetFile(file_name) as df:
+            for sample_id, data in df.iter_samples([sample_id for _, sample_id in file_samples], SAMPLE_KEYS):
+                yield file_name, sample_id, data
+
+
+def get_error_outcome(error: Exception, data: dict) -> str:
+    if isinstance(error, ValueError) and "not valid" in str(error):
+        return "not_valid"
+    elif "Ground truth is less than 200 meters" in str(error):
+        return "short_gt"
+    elif "No routes found" in str(error):
+        return "no_routes_close_by"
+    print("UNEXPECTED ERROR", error, data["sequence_id"], "SKIPPING!!!", sep="\n")
+    if debug:
+        raise error
+    return "other_route_errors"
+
+
+def process_sample(data: dict, wrapper, worker_id) -> list[tuple[str, str, dict]]:
+    """
+    Returns the outcome, the sequence_id and the sample to write if any of every prediction time of one sample, the
+    outcome named like the counters of the worker. Without --prediction_stride there is one prediction time, the
+    middle frame. Outcomes before the prediction times are known are returned once under the sequence_id of the
+    sample.
+    """
+    sequence_id = data["sequence_id"]
+    if prediction_stride <= 0 and sequence_id in existing_sequence_ids:
+        print(f"worker {worker_id} skipped {sequence_id}, already exists")
+        return [("already_exists", sequence_id, None)]
+    if "lcm_data" not in data:
+        return [("no_lcm_data", sequence_id, None)]
+    if "lcm_lat_acceleration" not in data["lcm_data"]:
+        print(f"worker {worker_id} skipped {sequence_id}, lcm data contains only oxts data")
+        return [("incomplete_lcm_data", sequence_id, None)]
+
+    if prediction_stride <= 0:
+        # 2. Create a data_out dictionary and add kinematics and ground truth to it
         try:
-            data_out = create_route(data_out, wrapper)
+            with timer.stage("retrieve_kinematics"):
+                data_out = retrieve_kinemetic_data_and_gt(data)
+            data_out = create_route(data_out, wrapper, max_routes, max_route_expansions, scoring_step)
         except Exception as e:
-            if "Ground truth is less than 200 meters" in str(e):
-                short_gt += 1
-                continue
-            elif "No routes found" in str(e):
-                no_routes_close_by += 1
-                continue
-            else:
-                other_route_errors += 1
-                print("UNEXPECTED ERROR", e, data["sequence_id"], "SKIPPING!!!", sep="\n")
-                if debug:
-                    raise
+            return [(get_error_outcome(e, data), sequence_id, None)]
+        return [("count", sequence_id, data_out)]
+
+    # several prediction times, named <sequence_id>_<frame>
+    frames = get_prediction_frames(data["lcm_data"], prediction_stride)
+    frame_ids = [f"{sequence_id}_{frame}" for frame in frames]
+    outcomes = [None] * len(frames)
+    new_frames = []
+    for i, frame_id in enumerate(frame_ids):
+        if frame_id in existing_sequence_ids:
+            outcomes[i] = ("already_exists", frame_id, None)
+        else:
+            new_frames.append(i)
+    if len(new_frames) < len(frames):
+        print(f"worker {worker_id} skipped {len(frames) - len(new_frames)} frames of {sequence_id}")
+    with timer.stage("retrieve_kinematics"):
+        data_outs = retrieve_kinemetic_data_and_gt_batch([data] * len(new_frames), [frames[i] for i in new_frames])
+    for i, data_out in zip(new_frames, data_outs):
+        if isinstance(data_out, dict):
+            data_out["sequence_id"] = frame_ids[i]
+            data_out["prediction_frame"] = frames[i]
+    # the map and the tree are built once for all prediction times
+    routable = [data_out for data_out in data_outs if isinstance(data_out, dict)]
+    try:
+        routed = create_routes(routable, wrapper, max_routes, max_route_expansions, scoring_step) if routable else []
+    except Exception as e:
+        routed = [e] * len(routable)
+    routed = iter(routed)
+    for i, data_out in zip(new_frames, data_outs):
+        if isinstance(data_out, dict):
+            data_out = next(routed)
+        if isinstance(data_out, Exception):
+            outcomes[i] = (get_error_outcome(data_out, data), frame_ids[i], None)
+        else:
+            outcomes[i] = ("count", frame_ids[i], data_out)
+    return outcomes
+
+
+def worker(worker_data):
+
+    samples, worker_id = worker_data
+    # print(f"worker {worker_id} started processing {len(samples)} samples")
+
+    wrapper = get_wrapper()
+    manifest = get_manifest()
+    shard_writer = get_shard_writer() if output_format == "shards" else None
+    cache_stats_start = get_cache_stats(wrapper)
+
+    counts = dict.fromkeys(OUTCOMES, 0)
+    batch = timer.iterate("load_sample", iter_batch(samples))
+    prefetcher = None
+    if prefetch > 0 and wrapper.store is None:
+        # maps are downloaded or read from the tile cache, overlap that with routing
+        prefetcher = MapPrefetcher(wrapper, prefetch, prefetch_threads)
+        batch = prefetcher.iterate(batch, lambda item: get_prediction_area(item[2], wrapper))
+    # 1. Load sample with data
+    for file_name, data_point, data in batch:
+        outcomes = process_sample(data, wrapper, worker_id)
+        for outcome, sequence_id, data_out in outcomes:
+            counts[outcome] += 1
+            # the sample is finished once every one of its prediction times has a final outcome
+            entry = (file_name, data_point, sequence_id, outcome, len(outcomes))
+            if outcome != "count":
+                manifest.record(*entry)
                 continue
-        count += 1
-        writer(f'{output + "/" + data_out["sequence_id"]}', data_out)
-
-    del wrapper
-    return (
-        count,
-        no_lcm_data,
-        incomplete_lcm_data,
-        not_valid,
-        already_exists,
-        short_gt,
-        no_routes_close_by,
-        other_route_errors,
+            with timer.stage("write"):
+                if shard_writer is not None:
+                    # written samples are recorded only once their shard is finalized, so none is ever lost
+                    _unrecorded.setdefault(sequence_id, []).append(entry)
+                    shard_writer.add_sample(data_out)
+                else:
+                    writer(f'{output + "/" + data_out["sequence_id"]}', data_out)
+                    manifest.record(*entry)
+
+    if prefetcher is not None:
+        prefetcher.close()
+
+    cache_stats = {key: value - cache_stats_start[key] for key, value in get_cache_stats(wrapper).items()}
+    return tuple(counts.values()) + (
+        cache_stats["memory_hits"] + cache_stats["disk_hits"],
+        cache_stats["misses"],
+        cache_stats["fetch_time"],
+        # stage histograms of this batch, merged by the parent
+        timer.pop_stats(),
     )
 
 
+def index_shards():
+    """Writes index.json over all finalized shards of the output folder."""
+    index = build_index(output)
+    print(f"Indexed {len(index['sequence_ids'])} samples in {len(index['shards'])} shards")
+
+
 def main():
 
     # Open data folder
@@ -229,7 +560,6 @@ def main():
         file_list = file_list[start:]
 
     file_names = [folder_name + "/" + file for file in file_list]
-    worker_ids = range(len(file_names))
 
     # first iterate over filenames and make sure they are not corrupted
     check_corrupted = False
@@ -252,16 +582,24 @@ def main():
 
         file_names = [file for file in file_names if file not in corrupted_files]
 
-    out_together = {
-        "count": 0,
-        "no_lcm_data": 0,
-        "incomplete_lcm_data": 0,
-        "not_valid": 0,
-        "already_exists": 0,
-        "short_gt": 0,
-        "no_routes_close_by": 0,
-        "other_route_errors": 0,
-    }
+    # workers pull the batches one by one from the pool's task queue
+    if plan_regions:
+        samples = order_by_region(file_names, region_tile_deg)
+    else:
+        samples = [sample for file_name in file_names for sample in list_samples(file_name)]
+    # samples with a final outcome in the manifest are never loaded again
+    finished = get_manifest().load_finished()
+    num_samples = len(samples)
+    samples = [sample for sample in samples if (os.path.basename(sample[0]), sample[1]) not in finished]
+    num_finished = num_samples - len(samples)
+    print(f"Skipping {num_finished} samples already processed according to the manifest")
+    batches = make_batches(samples, workers, batch_size, min_batch_size)
+    print(f"Planned {len(batches)} batches of {min_batch_size} to {batch_size} samples for {len(samples)} samples")
+    worker_ids = range(len(batches))
+
+    out_together = dict.fromkeys(OUTCOMES, 0)
+    out_together.update({"map_cache_hits": 0, "map_cache_misses": 0, "map_fetch_time": 0.0})
+    out_together["already_exists"] = num_finished
 
     def print_out(out, max_key_length):
         for key, value in out.items():
@@ -269,25 +607,59 @@ def main():
         print("\n")
         sys.stdout.flush()
 
+    shared_map = None
+    if map_file is not None and use_shared_map:
+        shared_map = SharedMap.create(map_arrays_from_file(map_file))
+        set_shared_map(shared_map.spec)
+        print(f"Loaded {map_file} into shared memory")
+
+    start_time = time.time()
+    last_report = start_time
+
     if debug:
-        for f, i in zip(file_names, worker_ids):
-            print(f"worker {i} started processing {f}")
-            worker((f, i))
+        init_process(shared_map_spec)
+        for batch, i in zip(batches, worker_ids):
+            print(f"worker {i} started processing {len(batch)} samples")
+            out = worker((batch, i))
+            for j, key in enumerate(out_together.keys()):
+                out_together[key] += out[j]
+            timer.merge(out[-1])
+        close_shard_writer()
+        write_report(timing_report, timer, out_together, time.time() - start_time)
+        if shared_map is not None:
+            shared_map.close()
+            shared_map.unlink()
+        if output_format == "shards":
+            index_shards()
         exit()
 
     max_key_length = max(len(key) for key in out_together.keys())
     try:
-        with Pool(workers) as p:
-            for out in tqdm(p.imap_unordered(worker, zip(file_names, worker_ids)), total=len(file_names)):
+        with Pool(workers, initializer=init_process, initargs=(shared_map_spec,)) as p:
+            for out in tqdm(p.imap_unordered(worker, zip(batches, worker_ids)), total=len(batches)):
                 for i, key in enumerate(out_together.keys()):
                     out_together[key] += out[i]
+                timer.merge(out[-1])
                 print_out(out_together, max_key_length)
+                if time.time() - last_report > report_interval:
+                    write_report(timing_report, timer, out_together, time.time() - start_time)
+                    last_report = time.time()
+            # workers finalize their last shard when they exit, terminating them would lose it
+            p.close()
+            p.join()
     except Exception as e:
         print(f"Error processing files: {e}")
         traceback.print_exc()
     finally:
         print("Final Summary:")
         print_out(out_together, max_key_length)
+        write_report(timing_report, timer, out_together, time.time() - start_time)
+        print(f"Timing report written to {timing_report}")
+        if shared_map is not None:
+            shared_map.close()
+            shared_map.unlink()
+        if output_format == "shards":
+            index_shards()
 
 
 if __name__ == "__main__":
@@ -301,6 +673,95 @@ if __name__ == "__main__":
     parser.add_argument(
         "--debug", action="store_true", help="Whether to run without multiprocessing. If true, num_workers is ignored."
     )
+    parser.add_argument(
+        "--map_file",
+        type=str,
+        default=None,
+        help="Local OSM extract (.osm, .osm.pbf or .graphml). If given, no map data is downloaded.",
+    )
+    parser.add_argument(
+        "--shared_map",
+        action="store_true",
+        help="Load --map_file once into shared memory that all workers read, instead of once per worker.",
+    )
+    parser.add_argument(
+        "--map_cache",
+        type=str,
+        default=None,
+        help="Folder for cached map tiles, shared by all workers. Only used when no --map_file is given.",
+    )
+    parser.add_argument(
+        "--plan_by_region",
+        action="store_true",
+        help="Read the position of every sample first and give each worker batches of samples close to each other.",
+    )
+    parser.add_argument(
+        "--region_tile_deg", type=float, default=0.01, help="Tile size in degrees used to group samples by region."
+    )
+    parser.add_argument("--batch_size", type=int, default=32, help="Maximum number of samples per batch.")
+    parser.add_argument(
+        "--min_batch_size",
+        type=int,
+        default=1,
+        help="Minimum number of samples per batch, batches shrink towards it as the remaining work gets smaller.",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=None,
+        help="Number of upcoming samples whose maps are fetched in the background, 0 to disable. Not used with "
+        "--map_file. Defaults to 4 with --map_cache and to 0 otherwise, to not send more requests to Overpass.",
+    )
+    parser.add_argument("--prefetch_threads", type=int, default=2, help="Number of maps fetched at the same time.")
+    parser.add_argument(
+        "--max_routes", type=int, default=20000, help="Maximum number of candidate routes per sample, 0 for no limit."
+    )
+    parser.add_argument(
+        "--max_route_expansions",
+        type=int,
+        default=2000000,
+        help="Maximum number of road segments followed by the route search per sample, 0 for no limit.",
+    )
+    parser.add_argument(
+        "--scoring_step", type=float, default=2.0, help="Distance in m between the points compared to the ground truth."
+    )
+    parser.add_argument(
+        "--prediction_stride",
+        type=int,
+        default=0,
+        help="Oxts frames between the prediction times of a sequence, 0 for only the middle frame. All prediction "
+        "times of a sequence share one map and one tree.",
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="pickle",
+        choices=["pickle", "shards"],
+        help="One pickle per sample, or HDF5 shards of many samples with an index.json.",
+    )
+    parser.add_argument("--shard_size", type=int, default=1024, help="Maximum number of samples per shard.")
+    parser.add_argument(
+        "--shard_compression",
+        type=str,
+        default=None,
+        choices=["gzip", "lzf"],
+        help="Compression of the shard arrays, uncompressed shards can be memory-mapped by readers.",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help="Folder of the run manifest, the outcome of every processed sample. Defaults to <output>/manifest.",
+    )
+    parser.add_argument(
+        "--timing_report",
+        type=str,
+        default=None,
+        help="JSON file for the time spent per pipeline stage. Defaults to <output>/timing_report.json.",
+    )
+    parser.add_argument(
+        "--report_interval", type=float, default=60.0, help="Seconds between updates of the timing report."
+    )
     parser.add_argument(
         "--check_corrupted",
         action="store_true",
@@ -311,14 +772,46 @@ if __name__ == "__main__":
 
     # remove files from output
     os.makedirs(args.output, exist_ok=True)
+    manifest_dir = args.manifest if args.manifest else os.path.join(args.output, "manifest")
     if args.overwrite:
         for file in os.listdir(args.output):
-            os.remove(os.path.join(args.output, file))
+            path = os.path.join(args.output, file)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        if os.path.isdir(manifest_dir):
+            shutil.rmtree(manifest_dir)
 
     folder_name = args.input
     output = args.output
     existing_files = os.listdir(output)
+    existing_sequence_ids = {os.path.splitext(file)[0] for file in existing_files if file.endswith(".pkl")}
+    for shard in list_shards(output):
+        existing_sequence_ids.update(read_shard_sequence_ids(os.path.join(output, shard)))
     debug = args.debug
+    map_file = args.map_file
+    use_shared_map = args.shared_map
+    map_cache = args.map_cache
+    plan_regions = args.plan_by_region
+    region_tile_deg = args.region_tile_deg
+    batch_size = args.batch_size
+    min_batch_size = args.min_batch_size
+    if args.prefetch is not None:
+        prefetch = args.prefetch
+    else:
+        prefetch = 4 if map_cache is not None else 0
+    prefetch_threads = args.prefetch_threads
+    max_routes = args.max_routes if args.max_routes > 0 else None
+    max_route_expansions = args.max_route_expansions if args.max_route_expansions > 0 else None
+    scoring_step = args.scoring_step
+    prediction_stride = args.prediction_stride
+    output_format = args.output_format
+    shard_size = args.shard_size
+    shard_compression = args.shard_compression
+    run_version = get_run_version()
+    timing_report = args.timing_report if args.timing_report else os.path.join(output, "timing_report.json")
+    report_interval = args.report_interval
 
     if args.workers > 0:
         workers = args.workers
@@ -327,8 +820,8 @@ if __name__ == "__main__":
 
     print(f"pickling protocol: {pickle.HIGHEST_PROTOCOL}")
     print(f"Input hdf5 file: {folder_name}")
-    print(f"Output pickle folder: {output}")
+    print(f"Output {output_format} folder: {output}")
+    print(f"Map source: {map_file if map_file else 'Overpass'}")
 
-    load_dataset.load_recursively = load_recursively
 
     main()
@@ -3,23 +3,30 @@ import shapely
 from shapely.ops import substring
 
 import numpy as np
+from geopy.distance import geodesic
 from shapely.geometry import LineString, Point
 
 from enums import Direction
-from osm_wrapper import OSMWrapper
+from osm_wrapper import GeoRectangle, OSMWrapper
+from timing import timer
 from tree import Tree
-from utils import convert_shapepoint_to_vehicle_coords, get_link_connecting_nodes, transform_to_vehicle_coordinates
-
-def create_map(lat, lon, wrapper: OSMWrapper):
+from utils import convert_shapepoint_to_vehicle_coords, get_link_connecting_nodes, interpolate_polylines
 
+def get_map_rectangle(lat, lon, wrapper: OSMWrapper):
+    """The area around the ego vehicle whose links make up the map of a sample."""
     side_rectangle_m = 400  #
-    geo_rectangle = wrapper.rectangle_by_center_and_edges(
+    return wrapper.rectangle_by_center_and_edges(
         lon,
         lat,
         side_rectangle_m,
         side_rectangle_m,
     )
 
+
+def create_map(lat, lon, wrapper: OSMWrapper):
+
+    geo_rectangle = get_map_rectangle(lat, lon, wrapper)
+
     links_in_area = wrapper.get_links(geo_rectangle)
     links = []
     for link in links_in_area:
@@ -29,23 +36,48 @@ def create_map(lat, lon, wrapper: OSMWrapper):
 
 
 
-def get_area_between_lines(line1: LineString, line2: LineString):
+def resample_lines(lines: list[LineString], step=2.0, length=200.0) -> np.ndarray:
     """
-    Calculate the area that is between two lines. Discretize the lines into points and calculate total distance between the points.
+    Interpolates a point every step m along each line, up to length m, in one vectorized call.
+    Returns an (R, K, 2) array for R lines and K = len(np.arange(0, length, step)) points.
     """
-    assert np.isclose(line1.length, line2.length, atol=200), "Lines must be 200 meters long"
+    distances = np.arange(0, length, step)
+    points = shapely.line_interpolate_point(np.array(lines, dtype=object)[:, np.newaxis], distances[np.newaxis, :])
+    return shapely.get_coordinates(points.ravel()).reshape(len(lines), len(distances), 2)
 
-    # Generate interpolation distances
-    distances = np.arange(0, 200, 2)
 
-    # Interpolate points on both lines
-    line1_points = np.array([line1.interpolate(distance).coords[0] for distance in distances])
-    line2_points = np.array([line2.interpolate(distance).coords[0] for distance in distances])
+def get_areas_between_lines_and_gt(lines: list[LineString], gt_line: LineString, step=2.0) -> np.ndarray:
+    """
+    Vectorized get_area_between_lines of every line against the ground truth, one score per line.
+    """
+    lines_points = resample_lines(lines, step)
+    gt_points = resample_lines([gt_line], step)
 
     # Calculate distances between corresponding points using NumPy for vectorized operations
-    total_distance = np.sum(np.sqrt(np.sum((line1_points - line2_points) ** 2, axis=1)))
+    return np.sum(np.sqrt(np.sum((lines_points - gt_points) ** 2, axis=2)), axis=1)
+
+
+def get_areas_between_routes_and_gt(
+    route_coords: np.ndarray, route_offsets: np.ndarray, gt_line: LineString, step=2.0
+) -> np.ndarray:
+    """
+    get_areas_between_lines_and_gt for routes given as one coordinate array with offsets, no shapely objects are
+    created for the routes.
+    """
+    routes_points = interpolate_polylines(route_coords, route_offsets, np.arange(0, 200, step))
+    gt_points = resample_lines([gt_line], step)
+
+    return np.sum(np.sqrt(np.sum((routes_points - gt_points) ** 2, axis=2)), axis=1)
+
+
+def get_area_between_lines(line1: LineString, line2: LineString, step=2.0):
+    """
+    Calculate the area that is between two lines. Discretize the lines into points and calculate total distance between the points.
+    """
+    assert np.isclose(line1.length, line2.length, atol=200), "Lines must be 200 meters long"
+
+    return get_areas_between_lines_and_gt([line1], line2, step)[0]
 
-    return total_distance
 
 def get_route_properties(tree: Tree, best_route_index, wrapper, vehicle_data):
     props = {}
@@ -63,9 +95,8 @@ def get_route_properties(tree: Tree, best_route_index, wrapper, vehicle_data):
     for i, node in enumerate(route_nodes):
         if i == 0:
             continue
-        link, reversed = get_link_connecting_nodes(route_nodes[i - 1], node, wrapper)
-        link_in_local_coords = transform_to_vehicle_coordinates(vehicle_data, link)
-        link_length = LineString(link_in_local_coords).length
+        link, reversed = get_link_connecting_nodes(route_nodes[i - 1], node, wrapper, tree.geometry_cache)
+        link_length = tree.geometry_cache.get(link).length
 
         route_links.append(link)
         reversed_list.append(reversed)
@@ -106,7 +137,15 @@ def get_route_properties(tree: Tree, best_route_index, wrapper, vehicle_data):
     # get the number of branches
     return props
 
-def create_route(output_dict, wrapper):
+def get_vehicle_data(output_dict) -> dict:
+    return {
+        "ego_vehicle_lat": output_dict["pred_time"]["lat"],
+        "ego_vehicle_lon": output_dict["pred_time"]["lon"],
+        "ego_vehicle_yaw": output_dict["pred_time"]["heading"],
+    }
+
+
+def check_gt_length(output_dict):
     # check if the length of the ground truth is less than 200 meters
     if (
         LineString(
@@ -117,47 +156,117 @@ def create_route(output_dict, wrapper):
         # TODO skip sample
         raise ValueError("Ground truth is less than 200 meters")
 
-    map_links = create_map(output_dict["pred_time"]["lat"], output_dict["pred_time"]["lon"], wrapper)
+
+def build_tree(map_links, wrapper, vehicle_data) -> Tree:
+    with timer.stage("tree"):
+        tree = Tree(map_links, wrapper, vehicle_data)
+        tree.inspect_connections() # for debugging
+    return tree
+
+
+def create_route(output_dict, wrapper, max_routes=None, max_expansions=None, scoring_step=2.0):
+    check_gt_length(output_dict)
+
+    with timer.stage("create_map"):
+        map_links = create_map(output_dict["pred_time"]["lat"], output_dict["pred_time"]["lon"], wrapper)
     output_dict["map_data"] = map_links
 
-    vehicle_data = {
-        "ego_vehicle_lat": output_dict["pred_time"]["lat"],
-        "ego_vehicle_lon": output_dict["pred_time"]["lon"],
-        "ego_vehicle_yaw": output_dict["pred_time"]["heading"],
-    }
-    tree = Tree(map_links, wrapper, vehicle_data)
-    tree.inspect_connections() # for debugging
-    tree.insert_start_points(10, iter=0)
-    tree.find_possible_routes()
+    tree = build_tree(map_links, wrapper, get_vehicle_data(output_dict))
+    return find_best_route(output_dict, tree, wrapper, max_routes, max_expansions, scoring_step)
+
+
+def get_sequence_map_rectangle(positions, wrapper: OSMWrapper) -> GeoRectangle:
+    """The smallest area containing the map rectangles of all (lat, lon) positions."""
+    lats = [lat for lat, _ in positions]
+    lons = [lon for _, lon in positions]
+    center_lat = (min(lats) + max(lats)) / 2
+    center_lon = (min(lons) + max(lons)) / 2
+    side_rectangle_m = get_map_rectangle(lats[0], lons[0], wrapper).width_m
+    return wrapper.rectangle_by_center_and_edges(
+        center_lon,
+        center_lat,
+        geodesic((center_lat, min(lons)), (center_lat, max(lons))).meters + side_rectangle_m,
+        geodesic((min(lats), center_lon), (max(lats), center_lon)).meters + side_rectangle_m,
+    )
+
+
+def create_routes(output_dicts, wrapper, max_routes=None, max_expansions=None, scoring_step=2.0) -> list:
+    """
+    create_route for several prediction times of the same sequence. The map of all of them is fetched once and the
+    tree is built once, for every prediction time it is only moved into the vehicle frame of that time.
+    Returns the output of every prediction time, or the exception it raised.
+    """
+    results = []
+    for output_dict in output_dicts:
+        try:
+            check_gt_length(output_dict)
+            results.append(output_dict)
+        except ValueError as e:
+            results.append(e)
+    # only prediction times with a long enough ground truth need a map
+    routed = [i for i, result in enumerate(results) if isinstance(result, dict)]
+    if not routed:
+        return results
+
+    # the map covers all prediction times, so it is the same area the map prefetcher requests
+    positions = [(output_dict["pred_time"]["lat"], output_dict["pred_time"]["lon"]) for output_dict in output_dicts]
+    with timer.stage("create_map"):
+        links = wrapper.get_links(get_sequence_map_rectangle(positions, wrapper))
+        map_links = [link.get_ID() for link in links]
+        geometries = np.array([link.get_geometry() for link in links], dtype=object)
+    base_tree = build_tree(map_links, wrapper, get_vehicle_data(results[routed[0]]))
+
+    for i in routed:
+        output_dict = results[i]
+        # the links of this prediction time, the same as if its own map had been fetched. They keep the order of
+        # the sequence query, which for a local map is the load order and so the order of its own query
+        rectangle = get_map_rectangle(output_dict["pred_time"]["lat"], output_dict["pred_time"]["lon"], wrapper)
+        rectangle = rectangle.get_box()
+        output_dict["map_data"] = [map_links[k] for k in np.flatnonzero(shapely.intersects(geometries, rectangle))]
+        try:
+            with timer.stage("tree"):
+                tree = base_tree.in_vehicle_frame(get_vehicle_data(output_dict), output_dict["map_data"])
+            find_best_route(output_dict, tree, wrapper, max_routes, max_expansions, scoring_step)
+        except Exception as e:
+            results[i] = e
+    return results
+
+
+def find_best_route(output_dict, tree: Tree, wrapper, max_routes=None, max_expansions=None, scoring_step=2.0):
+    """Searches the routes from the ego vehicle in the tree and adds the one closest to the ground truth."""
+    vehicle_data = tree.vehicle_data
+    with timer.stage("insert_start_points"):
+        tree.insert_start_points(10)
+    with timer.stage("find_possible_routes"):
+        tree.find_possible_routes(max_routes=max_routes, max_expansions=max_expansions)
 
     if not tree.routes:
         print(f"No routes found for sequence {output_dict['sequence_id']}")
         # TODO skip sample
         raise ValueError("No routes found")
 
-    shortest_frechet_distance = float("inf")
     ground_truth_translated = [
         [lat, lon] for lat, lon in zip(output_dict["gt"]["local_lat"], output_dict["gt"]["local_lon"])
     ]
     gt_linestring = LineString(ground_truth_translated)
     gt_linestring = substring(gt_linestring, 0, 200)
-    best_route_linestring = None
-    best_route_index = None
     output_dict["all_route_coords"] = []
     # node_routes = tree.get_routes_as_nodes() #remove later, only for debugging
-    linestrings = tree.get_routes_as_linestrings()
-    if len(linestrings) == 0:
-        print(f"No routes found for sequence {output_dict['sequence_id']}")
-        raise ValueError("No routes found")
-    for i, route_linestring in enumerate(linestrings):
-        # output_dict["all_route_coords"].append(route_linestring.coords._coords.tolist())
-        frechet_distance_value = get_area_between_lines(substring(route_linestring, 0, 200), gt_linestring)
-        if frechet_distance_value < shortest_frechet_distance:
-            shortest_frechet_distance = frechet_distance_value
-            best_route_linestring = route_linestring
-            best_route_index = i
-    output_dict["route_coords"] = best_route_linestring.coords._coords.tolist()
-
-    output_dict["route_properties"] = get_route_properties(tree, best_route_index, wrapper, vehicle_data)
+    with timer.stage("scoring"):
+        route_coords, route_offsets = tree.get_routes_as_coords()
+        if len(route_offsets) == 1:
+            print(f"No routes found for sequence {output_dict['sequence_id']}")
+            raise ValueError("No routes found")
+        # interpolating the full route equals interpolating its first 200 m
+        frechet_distance_values = get_areas_between_routes_and_gt(
+            route_coords, route_offsets, gt_linestring, scoring_step
+        )
+        best_route_index = int(np.argmin(frechet_distance_values))
+    output_dict["route_coords"] = route_coords[
+        route_offsets[best_route_index] : route_offsets[best_route_index + 1]
+    ].tolist()
+
+    with timer.stage("route_properties"):
+        output_dict["route_properties"] = get_route_properties(tree, best_route_index, wrapper, vehicle_data)
 
     return output_dict
\ No newline at end of file
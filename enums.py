@@ -18,15 +18,33 @@ class RoadClass(Enum):
 
 
 class MapObjectId:
+    """Immutable id of the link going from node_id_a to node_id_b, usable as a dictionary key."""
+
+    __slots__ = ("node_id_a", "node_id_b")
+
     def __init__(self, node_id_a, node_id_b):
-        self.node_id_a = node_id_a
-        self.node_id_b = node_id_b
+        object.__setattr__(self, "node_id_a", node_id_a)
+        object.__setattr__(self, "node_id_b", node_id_b)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MapObjectId is immutable")
+
+    def __reduce__(self):
+        return MapObjectId, (self.node_id_a, self.node_id_b)
 
     def __str__(self):
         return f"{self.node_id_a}-{self.node_id_b}"
 
     def __eq__(self, other):
+        if not isinstance(other, MapObjectId):
+            return NotImplemented
         return self.node_id_a == other.node_id_a and self.node_id_b == other.node_id_b
 
+    def __hash__(self):
+        return hash((self.node_id_a, self.node_id_b))
+
+    def reversed(self):
+        return MapObjectId(self.node_id_b, self.node_id_a)
+
     def is_loop(self):
         return self.node_id_a == self.node_id_b
@@ -1,5 +1,7 @@
 import h5py
 import numbers
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
 
 
 def save_recursively(hdf_group: h5py.Group, data: dict):
@@ -14,11 +16,16 @@ def save_recursively(hdf_group: h5py.Group, data: dict):
             hdf_group.create_dataset(key, data=value)
 
 
+def is_selected(key: str, keys_to_extract: list) -> bool:
+    """Whether a key is part of the projection, keys_to_extract may contain glob patterns like "lcm_*quality*"."""
+    return not keys_to_extract or any(fnmatchcase(key, pattern) for pattern in keys_to_extract)
+
+
 def load_recursively(hdf_obj, keys_to_extract: list = []):
     data = {}
     # Extract attributes
     for name, attr_data in hdf_obj.attrs.items():
-        if not keys_to_extract or name in keys_to_extract:
+        if is_selected(name, keys_to_extract):
             data[name] = attr_data
     for key in hdf_obj.keys():
         if isinstance(hdf_obj[key], h5py.Group):
@@ -27,7 +34,7 @@ def load_recursively(hdf_obj, keys_to_extract: list = []):
             if not data[key]:
                 data.pop(key)
         if isinstance(hdf_obj[key], h5py.Dataset):
-            if not keys_to_extract or key in keys_to_extract:
+            if is_selected(key, keys_to_extract):
                 data[key] = hdf_obj[key][()]
 
     return data
@@ -35,20 +42,50 @@ def load_recursively(hdf_obj, keys_to_extract: list = []):
 
 class DatasetFile:
     def __init__(self, filename: str, write: bool = False):
+        """
+        Every method opens the file on its own, unless the DatasetFile is used as a context manager (or open() is
+        called), then one handle is kept open and shared until close().
+        """
         self.filename_ = filename
+        self.write_ = write
+        self.file_ = None
         if write:
             # Creates an empty file
             with h5py.File(self.filename_, "w") as f:
                 pass
 
+    def open(self) -> "DatasetFile":
+        if self.file_ is None:
+            self.file_ = h5py.File(self.filename_, "a" if self.write_ else "r")
+        return self
+
+    def close(self):
+        if self.file_ is not None:
+            self.file_.close()
+            self.file_ = None
+
+    def __enter__(self) -> "DatasetFile":
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @contextmanager
+    def _handle(self, mode: str):
+        if self.file_ is not None:
+            yield self.file_
+        else:
+            with h5py.File(self.filename_, mode) as f:
+                yield f
+
     def add_sample(self, sample_id: str, data: dict):
         # Append to the existing file
-        with h5py.File(self.filename_, "a") as f:
+        with self._handle("a") as f:
             f.create_group(sample_id)
             save_recursively(f[sample_id], data)
 
     def load_sample(self, sample_id: str, keys_to_extract=[]):
-        with h5py.File(self.filename_, "r") as f:
+        with self._handle("r") as f:
             data = {}
             if sample_id in f.keys():
                 data[sample_id] = load_recursively(f[sample_id], keys_to_extract)
@@ -57,25 +94,28 @@ class DatasetFile:
 
             return data
 
+    def iter_samples(self, sample_ids: list = None, keys_to_extract: list = []):
+        """
+        Lazily yields (sample_id, data) for the given samples, all samples if None. Only the datasets and attributes
+        in keys_to_extract are read, datasets are returned as NumPy arrays.
+        """
+        with self._handle("r") as f:
+            for sample_id in f.keys() if sample_ids is None else sample_ids:
+                if sample_id in f:
+                    yield sample_id, load_recursively(f[sample_id], keys_to_extract)
+                else:
+                    print(f"Could not load {sample_id}. Not found in {self.filename_}.")
+
     def get_file_information(self):
         information = {}
-        with h5py.File(self.filename_, "r") as f:
+        with self._handle("r") as f:
             information["groups"] = list(f.keys())
             information["attributes"] = dict(f.attrs)
 
         return information
 
     def load_all(self, keys_to_extract: list = []):
-        data = {}
-        info = self.get_file_information()
-        with h5py.File(self.filename_, "r") as f:
-            for sample_id in info["groups"]:
-                if sample_id in f.keys():
-                    data[sample_id] = load_recursively(f[sample_id], keys_to_extract)
-                else:
-                    print(f"Could not load {sample_id}.")
-
-            return data
+        return dict(self.iter_samples(keys_to_extract=keys_to_extract))
 
 
 def filter_by_gt(filename_in: str, filename_out: str, keys_to_extract: list = []):
@@ -0,0 +1,70 @@
+import json
+import os
+import uuid
+
+# outcomes that are retried on a rerun, every other outcome is final for the same version
+RETRIED_OUTCOMES = ["other_route_errors"]
+
+
+class RunManifest:
+    def __init__(self, manifest_dir: str, version: str):
+        """
+        Append-only log of every processed sample and its outcome. Every process appends to its own JSONL file in
+        manifest_dir, so any number of workers can record at the same time without locking. A line is written and
+        flushed per sample, a line cut off by a crash is ignored when loading.
+        :param version: Code and config version, entries of other versions don't count as finished
+        """
+        self.manifest_dir = manifest_dir
+        self.version = version
+        self.file_ = None
+        os.makedirs(manifest_dir, exist_ok=True)
+
+    def load_finished(self) -> set[tuple[str, str]]:
+        """
+        Returns (input file, sample_id) of every sample with a final outcome for this version. A sample with several
+        prediction times is only finished once each of them, by sequence_id, has one. A final outcome wins over any
+        retried one, so the result doesn't depend on the order of the entries or of the files.
+        """
+        # (input file, sample_id) -> sequence_ids with a final outcome, and the number of prediction times
+        final = {}
+        num_frames = {}
+        for file_name in os.listdir(self.manifest_dir):
+            if not file_name.endswith(".jsonl"):
+                continue
+            with open(os.path.join(self.manifest_dir, file_name)) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if entry["version"] != self.version:
+                        continue
+                    key = (entry["file"], entry["sample_id"])
+                    num_frames[key] = max(num_frames.get(key, 1), entry.get("num_frames", 1))
+                    if entry["outcome"] not in RETRIED_OUTCOMES:
+                        final.setdefault(key, set()).add(entry["sequence_id"])
+        return {key for key, sequence_ids in final.items() if len(sequence_ids) >= num_frames[key]}
+
+    def record(self, file_name: str, sample_id: str, sequence_id: str, outcome: str, num_frames: int = 1):
+        """
+        :param sequence_id: sequence_id of the prediction time, e.g. <sequence_id>_<frame>
+        :param num_frames: Number of prediction times of the sample
+        """
+        if self.file_ is None:
+            path = os.path.join(self.manifest_dir, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.jsonl")
+            self.file_ = open(path, "a")
+        entry = {
+            "file": os.path.basename(file_name),
+            "sample_id": sample_id,
+            "sequence_id": sequence_id,
+            "outcome": outcome,
+            "num_frames": num_frames,
+            "version": self.version,
+        }
+        self.file_.write(json.dumps(entry) + "\n")
+        self.file_.flush()
+
+    def close(self):
+        if self.file_ is not None:
+            self.file_.close()
+            self.file_ = None
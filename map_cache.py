@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from math import floor
+
+import numpy as np
+from geopy.point import Point
+
+from osm_wrapper import GeoRectangle, Link, LinkStore, OSMWrapper, graph_to_arrays, links_from_arrays
+
+
+class TileCache:
+    def __init__(self, cache_dir: str = None, max_tiles: int = 64):
+        """
+        Two level cache of map tiles: a size-bounded LRU of decoded tiles in memory and, optionally, one compressed
+        file per tile on disk. The disk level can be shared by several processes, files are written atomically.
+        :param cache_dir: Folder for the tile files, None keeps the cache in memory only
+        :param max_tiles: Number of decoded tiles kept in memory
+        """
+        self.cache_dir = cache_dir
+        self.max_tiles = max_tiles
+        self.tiles: OrderedDict[tuple[int, int], LinkStore] = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.fetch_time = 0.0
+        # tiles can be requested from several threads, a tile being loaded is loaded only once
+        self.lock = threading.Lock()
+        self.loading: dict[tuple[int, int], threading.Event] = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def tile_path(self, key: tuple[int, int]) -> str:
+        return os.path.join(self.cache_dir, f"{key[0]}_{key[1]}.npz")
+
+    def get(self, key: tuple[int, int], fetch) -> LinkStore:
+        """
+        Returns the tile, calling fetch(key) for the edge arrays of the tile if it is neither in memory nor on disk.
+        Thread-safe, a thread requesting a tile that another thread is loading waits for it.
+        """
+        with self.lock:
+            if key in self.tiles:
+                self.memory_hits += 1
+                self.tiles.move_to_end(key)
+                return self.tiles[key]
+            loading = self.loading.get(key)
+            if loading is None:
+                self.loading[key] = threading.Event()
+        if loading is not None:
+            loading.wait()
+            return self.get(key, fetch)
+
+        try:
+            store = self.load(key, fetch)
+            with self.lock:
+                self.tiles[key] = store
+                if len(self.tiles) > self.max_tiles:
+                    self.tiles.popitem(last=False)
+            return store
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+    def load(self, key: tuple[int, int], fetch) -> LinkStore:
+        if self.cache_dir is not None and os.path.exists(self.tile_path(key)):
+            with self.lock:
+                self.disk_hits += 1
+            with np.load(self.tile_path(key)) as f:
+                arrays = dict(f)
+        else:
+            start = time.perf_counter()
+            arrays = fetch(key)
+            with self.lock:
+                self.misses += 1
+                self.fetch_time += time.perf_counter() - start
+            if self.cache_dir is not None:
+                # write to a temporary file first, other workers must never read a partial tile
+                tmp_path = f"{self.tile_path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as handle:
+                    np.savez_compressed(handle, **arrays)
+                os.replace(tmp_path, self.tile_path(key))
+        return LinkStore(links_from_arrays(arrays))
+
+    def get_stats(self) -> dict:
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "fetch_time": self.fetch_time,
+        }
+
+
+class CachedOSMWrapper(OSMWrapper):
+    def __init__(self, cache_dir: str = None, max_tiles: int = 64, tile_size_deg: float = 0.01):
+        """
+        OSMWrapper that downloads the map in fixed tiles of tile_size_deg x tile_size_deg degrees and caches them.
+        Queries are answered from all tiles overlapping the requested area.
+        """
+        super().__init__()
+        self.tile_size_deg = tile_size_deg
+        self.cache = TileCache(cache_dir, max_tiles)
+
+    def tile_keys(self, geo_rectangle: GeoRectangle) -> list[tuple[int, int]]:
+        lower_left = geo_rectangle.get_lower_left()
+        upper_right = geo_rectangle.get_upper_right()
+        lat_range = range(
+            floor(lower_left.latitude / self.tile_size_deg), floor(upper_right.latitude / self.tile_size_deg) + 1
+        )
+        lon_range = range(
+            floor(lower_left.longitude / self.tile_size_deg), floor(upper_right.longitude / self.tile_size_deg) + 1
+        )
+        return [(lat_key, lon_key) for lat_key in lat_range for lon_key in lon_range]
+
+    def fetch_tile(self, key: tuple[int, int]) -> dict:
+        tile = GeoRectangle()
+        tile.set_lower_left(Point(key[0] * self.tile_size_deg, key[1] * self.tile_size_deg))
+        tile.set_upper_right(Point((key[0] + 1) * self.tile_size_deg, (key[1] + 1) * self.tile_size_deg))
+        # the graph is downloaded in a square of +-dist around the center, it has to contain the whole tile
+        graph = self.get_graph_from_point(
+            tile.get_center().latitude, tile.get_center().longitude, dist=tile.get_half_size_m() + 1
+        )
+        return graph_to_arrays(graph)
+
+    def query_links(self, geo_rectangle: GeoRectangle) -> list[Link]:
+        links = {}
+        for key in self.tile_keys(geo_rectangle):
+            for link in self.cache.get(key, self.fetch_tile).query(geo_rectangle):
+                # edges crossing a tile border are part of both tiles
+                links.setdefault(link.get_ID(), link)
+        return list(links.values())
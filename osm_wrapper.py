@@ -1,5 +1,11 @@
+import json
+
+import numpy as np
 import osmnx as ox
+import shapely
+import utm
 from enums import Direction, RoadClass, MapObjectId
+from shapely import STRtree, box
 from shapely.geometry import LineString
 
 from geopy.distance import distance
@@ -8,7 +14,34 @@ from geopy.point import Point
 import warnings
 from math import nan
 
-    
+
+# Same exclusions as the osmnx "drive" network type, local extracts contain every way
+DRIVE_EXCLUDED_HIGHWAYS = {
+    "abandoned",
+    "bridleway",
+    "bus_guideway",
+    "construction",
+    "corridor",
+    "cycleway",
+    "elevator",
+    "escalator",
+    "footway",
+    "no",
+    "path",
+    "pedestrian",
+    "planned",
+    "platform",
+    "proposed",
+    "raceway",
+    "razed",
+    "service",
+    "steps",
+    "track",
+}
+
+# Edge attributes read by Link, the only ones kept when links are serialized
+LINK_ATTRIBUTES = ["lanes", "length", "maxspeed", "highway", "tunnel", "bridge"]
+
 class GeoRectangle:
     def __init__(self, center_of_rectangle=None, width_m=None, height_m=None):
         """
@@ -70,6 +103,19 @@ class GeoRectangle:
         assert type(position) == Point
         self.upper_right = position
 
+    def get_box(self):
+        """The rectangle as a shapely polygon in (latitude, longitude), the coordinate order of the link geometries."""
+        return box(
+            self.lower_left.latitude, self.lower_left.longitude, self.upper_right.latitude, self.upper_right.longitude
+        )
+
+    def get_half_size_m(self) -> float:
+        """Half of the longer side of the rectangle in m."""
+        center = self.get_center()
+        half_height_m = distance(center, Point(self.upper_right.latitude, center.longitude)).m
+        half_width_m = distance(center, Point(center.latitude, self.upper_right.longitude)).m
+        return max(half_height_m, half_width_m)
+
 
 class Link:
     def __init__(self, id: MapObjectId, data: dict):
@@ -91,6 +137,9 @@ class Link:
         self.highway = "highway" in data
         self.tunnel = "tunnel" in data
         self.bridge = "bridge" in data
+        # UTM points of the geometry and their (zone number, zone letter), set once by the store, see project_to_utm
+        self.metric_coords = None
+        self.utm_zone = None
 
         # Determine road class
         if "highway" in data:
@@ -149,28 +198,207 @@ class Link:
         return self.geometry
 
 
+def is_drivable(data: dict) -> bool:
+    """Whether an edge of a local extract belongs to the "drive" network requested from Overpass."""
+    highways = data.get("highway")
+    if highways is None:
+        return False
+    if not isinstance(highways, list):
+        highways = [highways]
+    if any(highway in DRIVE_EXCLUDED_HIGHWAYS for highway in highways):
+        return False
+    if data.get("area") == "yes":
+        return False
+    return data.get("motor_vehicle") != "no" and data.get("motorcar") != "no"
+
+
+def links_from_graph(graph) -> list[Link]:
+    """Creates a Link for every edge of an osmnx graph, geometries are (latitude, longitude)."""
+    links = []
+    for u, v, data in graph.edges(data=True):
+        if "geometry" not in data:
+            # If there is no geometry, the edge is a straight line, but we still need to create a LineString object and add it to the data
+            from_ = Point(longitude=graph.nodes[u]["x"], latitude=graph.nodes[u]["y"])
+            to_ = Point(longitude=graph.nodes[v]["x"], latitude=graph.nodes[v]["y"])
+            data["geometry"] = LineString([from_, to_])
+        id = MapObjectId(u, v)
+        link = Link(id, data)
+        links.append(link)
+    return links
+
+
+def graph_to_arrays(graph) -> dict:
+    """
+    Flattens the edges of an osmnx graph into arrays that can be saved to disk or shared between processes.
+    Geometries are stored as one (latitude, longitude) buffer, edge i spans coords[offsets[i]:offsets[i + 1]].
+    """
+    u, v, offsets, coords, attributes = [], [], [0], [], []
+    for from_node, to_node, data in graph.edges(data=True):
+        if "geometry" in data:
+            # osmnx stores (longitude, latitude)
+            edge_coords = [(lat, lon) for lon, lat in data["geometry"].coords]
+        else:
+            edge_coords = [
+                (graph.nodes[from_node]["y"], graph.nodes[from_node]["x"]),
+                (graph.nodes[to_node]["y"], graph.nodes[to_node]["x"]),
+            ]
+        u.append(from_node)
+        v.append(to_node)
+        coords.extend(edge_coords)
+        offsets.append(len(coords))
+        attributes.append({key: data[key] for key in LINK_ATTRIBUTES if key in data})
+    return {
+        "u": np.array(u, dtype=np.int64),
+        "v": np.array(v, dtype=np.int64),
+        "offsets": np.array(offsets, dtype=np.int64),
+        "coords": np.array(coords, dtype=np.float64).reshape(-1, 2),
+        "attributes": np.frombuffer(json.dumps(attributes).encode(), dtype=np.uint8),
+    }
+
+
+def links_from_arrays(arrays: dict) -> list[Link]:
+    """Inverse of graph_to_arrays."""
+    attributes = json.loads(arrays["attributes"].tobytes().decode())
+    offsets = arrays["offsets"]
+    links = []
+    for i, data in enumerate(attributes):
+        data["geometry"] = LineString(arrays["coords"][offsets[i] : offsets[i + 1]])
+        links.append(Link(MapObjectId(int(arrays["u"][i]), int(arrays["v"][i])), data))
+    return links
+
+
+def project_to_utm(coords: np.ndarray, offsets: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Projects the (latitude, longitude) points of many links into UTM, link i spans coords[offsets[i]:offsets[i + 1]].
+    Every link is projected into the zone of its first point, with one call per zone.
+    Returns the (N, 2) easting, northing points and the zone number and zone letter of every link.
+    """
+    first_points = coords[offsets[:-1]]
+    zone_numbers = np.array([utm.latlon_to_zone_number(lat, lon) for lat, lon in first_points], dtype=np.int64)
+    zone_letters = np.array([utm.latitude_to_zone_letter(lat) for lat, _ in first_points], dtype="U1")
+    link_of_point = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    metric_coords = np.empty(coords.shape, dtype=np.float64)
+    for zone_number, zone_letter in set(zip(zone_numbers.tolist(), zone_letters.tolist())):
+        in_zone = (zone_numbers == zone_number) & (zone_letters == zone_letter)
+        points = np.flatnonzero(in_zone[link_of_point])
+        x, y, _, _ = utm.from_latlon(coords[points, 0], coords[points, 1], zone_number, zone_letter)
+        metric_coords[points, 0] = x
+        metric_coords[points, 1] = y
+    return metric_coords, zone_numbers, zone_letters
+
+
+def set_metric_coords(links: list[Link]):
+    """Sets Link.metric_coords and Link.utm_zone of all links, projecting them together."""
+    if not links:
+        return
+    coords, link_index = shapely.get_coordinates([link.get_geometry() for link in links], return_index=True)
+    offsets = np.zeros(len(links) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(link_index, minlength=len(links)))
+    metric_coords, zone_numbers, zone_letters = project_to_utm(coords, offsets)
+    for i, link in enumerate(links):
+        link.metric_coords = metric_coords[offsets[i] : offsets[i + 1]]
+        link.utm_zone = (int(zone_numbers[i]), str(zone_letters[i]))
+
+
+def load_map_graph(map_file: str):
+    """Loads the drivable network of a local .osm/.osm.xml, .osm.pbf or GraphML extract as an osmnx graph."""
+    if map_file.endswith(".graphml"):
+        graph = ox.load_graphml(map_file)
+    elif map_file.endswith(".osm.pbf"):
+        try:
+            from pyrosm import OSM
+        except ImportError as e:
+            raise ImportError("Reading .osm.pbf extracts requires pyrosm, or convert the file to .osm") from e
+        osm = OSM(map_file)
+        nodes, edges = osm.get_network(nodes=True, network_type="driving")
+        graph = osm.to_graph(nodes, edges, graph_type="networkx", retain_all=True)
+    elif map_file.endswith((".osm", ".xml")):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", FutureWarning)
+            graph = ox.graph_from_xml(map_file, bidirectional=False, simplify=False, retain_all=True)
+    else:
+        raise ValueError(f"Unknown map file format: {map_file}")
+
+    not_drivable = [(u, v, k) for u, v, k, data in graph.edges(keys=True, data=True) if not is_drivable(data)]
+    graph.remove_edges_from(not_drivable)
+    return graph
+
+
+class LinkStore:
+    def __init__(self, links: list[Link]):
+        """
+        Holds all links of a region in memory and answers rectangle queries without network access.
+        :param links: The links of the region, geometries are (latitude, longitude)
+        """
+        self.links = links
+        self.tree = STRtree([link.get_geometry() for link in links])
+        # projected once here instead of for every sample that uses the link
+        set_metric_coords(links)
+
+    def __len__(self):
+        return len(self.links)
+
+    @classmethod
+    def from_file(cls, map_file: str) -> "LinkStore":
+        """Loads a local .osm/.osm.xml, .osm.pbf or GraphML extract."""
+        return cls(links_from_arrays(graph_to_arrays(load_map_graph(map_file))))
+
+    def query(self, geo_rectangle: GeoRectangle) -> list[Link]:
+        """Returns the links intersecting the rectangle, in the order they were loaded."""
+        indices = np.sort(self.tree.query(geo_rectangle.get_box(), predicate="intersects"))
+        return [self.links[i] for i in indices]
+
+
 class OSMWrapper:
-    def __init__(self):
-        pass
+    def __init__(self, map_file: str = None, store=None):
+        """
+        :param map_file: Optional local OSM extract. If given, the region is loaded once and every query is answered
+            from memory, otherwise each query downloads its graph from Overpass.
+        :param store: Optional region that is already loaded, a LinkStore or anything with the same query method
+        """
+        self.links = None
+        self.links_by_id: dict[MapObjectId, Link] = {}
+        self.store = store
+        # fetches of the next areas running in the background, see MapPrefetcher
+        self.prefetcher = None
+        if map_file is not None:
+            self.store = LinkStore.from_file(map_file)
 
     def get_graph_from_point(self, lat, lon, dist=500, network_type="drive"):
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", FutureWarning)
-            # dist is in meters
-            return ox.graph_from_point(
-                (lat, lon), dist=dist, network_type=network_type, retain_all=True, truncate_by_edge=True, simplify=False
-            )
+        # dist is in meters. Not wrapped in warnings.catch_warnings, it isn't thread-safe and this runs in the
+        # prefetch threads. create_data_samples filters the FutureWarnings of osmnx once per process
+        return ox.graph_from_point(
+            (lat, lon), dist=dist, network_type=network_type, retain_all=True, truncate_by_edge=True, simplify=False
+        )
             
     def project_graph(self, graph):
         return ox.project_graph(graph)
 
+    def set_links(self, links: list[Link]):
+        """Sets the links of the current area and rebuilds the id index."""
+        self.links = links
+        self.links_by_id = {}
+        for link in links:
+            # parallel edges share the id, the first one is kept
+            self.links_by_id.setdefault(link.get_ID(), link)
+
     def get_sd_object_by_id(self, link_id: MapObjectId) -> list[Link]:
-        """Return a list with the only element being the Link with the matching link id"""
+        """Return a list with the only element being the Link with the matching link id, empty if there is none"""
         if self.links is None:
             raise Exception("No links have been loaded yet")
-        for link in self.links:
-            if link.get_ID() == link_id:
-                return [link]
+        if link_id in self.links_by_id:
+            return [self.links_by_id[link_id]]
+        return []
+
+    def get_links_between(self, node_id_a, node_id_b) -> list[tuple[Link, bool]]:
+        """
+        Returns the links connecting two nodes in either orientation. The second element of each tuple is True if
+        the link is stored as node_id_b-node_id_a.
+        """
+        link_id = MapObjectId(node_id_a, node_id_b)
+        return [(link, False) for link in self.get_sd_object_by_id(link_id)] + [
+            (link, True) for link in self.get_sd_object_by_id(link_id.reversed())
+        ]
 
     @staticmethod
     def rectangle_by_center_and_edges(
@@ -179,21 +407,23 @@ class OSMWrapper:
         center_of_rectangle = Point(latitude=lat_center, longitude=lon_center)
         return GeoRectangle(center_of_rectangle, width_m, height_m)
 
-    def get_links(self, geo_rectangle: GeoRectangle) -> list[Link]:
+    def query_links(self, geo_rectangle: GeoRectangle) -> list[Link]:
+        """Returns all links intersecting the rectangle without changing the current links, safe to use in threads."""
+        if self.store is not None:
+            return self.store.query(geo_rectangle)
+        # the downloaded square contains the rectangle, the links outside of it are dropped
         graph = self.get_graph_from_point(
             geo_rectangle.get_center().latitude,
             geo_rectangle.get_center().longitude,
+            dist=geo_rectangle.get_half_size_m() + 1,
         )
         # projected_graph = self.project_graph(graph)
-        links = []
-        for u, v, data in graph.edges(data=True):
-            if "geometry" not in data:
-                # If there is no geometry, the edge is a straight line, but we still need to create a LineString object and add it to the data
-                from_ = Point(longitude=graph.nodes[u]["x"], latitude=graph.nodes[u]["y"])
-                to_ = Point(longitude=graph.nodes[v]["x"], latitude=graph.nodes[v]["y"])
-                data["geometry"] = LineString([from_, to_])
-            id = MapObjectId(u, v)
-            link = Link(id, data)
-            links.append(link)
-        self.links = links
+        return LinkStore(links_from_graph(graph)).query(geo_rectangle)
+
+    def get_links(self, geo_rectangle: GeoRectangle) -> list[Link]:
+        """Returns all links intersecting the rectangle and makes them the current links."""
+        links = self.prefetcher.take(geo_rectangle) if self.prefetcher is not None else None
+        if links is None:
+            links = self.query_links(geo_rectangle)
+        self.set_links(links)
         return links
@@ -0,0 +1,69 @@
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from osm_wrapper import GeoRectangle, Link, OSMWrapper
+
+
+def rectangle_key(geo_rectangle: GeoRectangle) -> tuple:
+    center = geo_rectangle.get_center()
+    return center.latitude, center.longitude, geo_rectangle.width_m, geo_rectangle.height_m
+
+
+class MapPrefetcher:
+    def __init__(self, wrapper: OSMWrapper, lookahead: int = 4, max_in_flight: int = 2):
+        """
+        Fetches the map areas of upcoming samples in background threads while the current sample is routed.
+        Once attached, wrapper.get_links takes the prefetched links of an area instead of fetching it again.
+        :param lookahead: Number of upcoming samples whose areas are fetched ahead
+        :param max_in_flight: Number of areas fetched at the same time
+        """
+        self.wrapper = wrapper
+        self.lookahead = lookahead
+        self.executor = ThreadPoolExecutor(max_in_flight, thread_name_prefix="map_prefetch")
+        self.pending: OrderedDict[tuple, Future] = OrderedDict()
+        wrapper.prefetcher = self
+
+    def prefetch(self, geo_rectangle: GeoRectangle):
+        key = rectangle_key(geo_rectangle)
+        if key in self.pending:
+            return
+        self.pending[key] = self.executor.submit(self.wrapper.query_links, geo_rectangle)
+        # the current sample and the upcoming ones, areas of skipped samples are never taken and dropped first
+        while len(self.pending) > self.lookahead + 1:
+            _, future = self.pending.popitem(last=False)
+            future.cancel()
+
+    def take(self, geo_rectangle: GeoRectangle) -> list[Link]:
+        """Returns the prefetched links of the area, waiting for them if needed, or None if it was not prefetched."""
+        future = self.pending.pop(rectangle_key(geo_rectangle), None)
+        if future is None or future.cancelled():
+            return None
+        # a failed fetch raises here, as if the area was fetched now
+        return future.result()
+
+    def iterate(self, items, get_area):
+        """
+        Yields the items, reading lookahead items ahead and prefetching get_area(item) for each of them.
+        get_area returns None for items without a map area.
+        """
+        upcoming = deque()
+        for item in items:
+            area = get_area(item)
+            if area is not None:
+                self.prefetch(area)
+            upcoming.append(item)
+            if len(upcoming) > self.lookahead:
+                yield upcoming.popleft()
+        while upcoming:
+            yield upcoming.popleft()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.pending.clear()
+        self.wrapper.prefetcher = None
+
+    def __enter__(self) -> "MapPrefetcher":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
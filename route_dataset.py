@@ -0,0 +1,176 @@
+import json
+import os
+
+import h5py
+import numpy as np
+
+from route_shards import INDEX_FILE, JSON_COLUMNS, list_shards
+
+
+def map_dataset(dataset: h5py.Dataset, shard_path: str):
+    """
+    Memory-maps a contiguous, uncompressed dataset straight from the shard file, so reading it is zero-copy.
+    Chunked or compressed datasets can't be mapped, None is returned and they are read through h5py on access.
+    """
+    offset = dataset.id.get_offset()
+    if dataset.size == 0:
+        return np.empty(dataset.shape, dtype=dataset.dtype)
+    if dataset.chunks is not None or offset is None:
+        return None
+    return np.memmap(shard_path, dtype=dataset.dtype, mode="r", offset=offset, shape=dataset.shape)
+
+
+class RaggedColumn:
+    def __init__(self, dataset: "RouteDataset", name: str, rows: np.ndarray):
+        """
+        One array per sample of a column spread over several shards. rows holds (shard, row) of every sample.
+        """
+        self.dataset = dataset
+        self.name = name
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        shard, row = self.rows[index]
+        return self.dataset.get_ragged(self.name, shard, row)
+
+
+class RouteDataset:
+    def __init__(self, dataset_dir: str, indices: np.ndarray = None):
+        """
+        Random access to the shards written by create_data_samples --output_format=shards. Every shard is read
+        once, its arrays are memory-mapped and only the small per-sample columns (strings, scalars, offsets) are
+        read into memory. Arrays that can't be mapped are read through h5py handles that every process opens on
+        first access, so forked DataLoader workers never share a handle. Usable as a map-style dataset of a
+        DataLoader, see shuffled and split for cheap views.
+        :param indices: Samples of the dataset in this view, all by default
+        """
+        self.dataset_dir = dataset_dir
+        index_path = os.path.join(dataset_dir, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.shards = json.load(f)["shards"]
+        else:
+            self.shards = list_shards(dataset_dir)
+
+        # shard -> h5py handle opened by the process with id pid, see get_file
+        self.files: dict[int, h5py.File] = {}
+        self.pid = os.getpid()
+        # name -> values per shard, arrays with one value per sample
+        self.columns: dict[str, list] = {}
+        # name -> (memory-mapped values per shard, None if not mappable, offsets per shard), one array per sample
+        self.ragged_columns: dict[str, tuple[list, list]] = {}
+        rows = []
+        for shard_number, shard in enumerate(self.shards):
+            shard_path = os.path.join(dataset_dir, shard)
+            with h5py.File(shard_path, "r") as f:
+                rows.extend((shard_number, row) for row in range(f.attrs["num_samples"]))
+
+                def add_column(name, obj):
+                    if isinstance(obj, h5py.Group) and obj.attrs.get("ragged", False):
+                        values, offsets = self.ragged_columns.setdefault(name, ([], []))
+                        values.append(map_dataset(obj["values"], shard_path))
+                        offsets.append(obj["offsets"][()])
+                    elif isinstance(obj, h5py.Dataset) and not obj.parent.attrs.get("ragged", False):
+                        values = obj.asstr()[()] if h5py.check_string_dtype(obj.dtype) else obj[()]
+                        self.columns.setdefault(name, []).append(values)
+
+                f.visititems(add_column)
+
+        self.rows = np.array(rows, dtype=np.int64).reshape(-1, 2)
+        self.sequence_ids = np.concatenate(self.columns["sequence_id"]) if self.shards else np.array([])
+        self.indices = np.arange(len(self.rows)) if indices is None else np.asarray(indices, dtype=np.int64)
+        # the first shard wins for duplicate sequence_ids, like in index.json
+        self.index_by_sequence_id = {}
+        for i, sequence_id in enumerate(self.sequence_ids):
+            self.index_by_sequence_id.setdefault(sequence_id, i)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, key) -> dict:
+        """Sample by position in this view or by sequence_id, nested like the samples of create_data_samples."""
+        sample = {}
+        for name in self.get_fields():
+            value = self.get_field(name, key)
+            if name in JSON_COLUMNS:
+                value = json.loads(value)
+            node = sample
+            *groups, field = name.split("/")
+            for group in groups:
+                node = node.setdefault(group, {})
+            node[field] = value
+        return sample
+
+    def get_fields(self) -> list[str]:
+        return list(self.columns) + list(self.ragged_columns)
+
+    def get_row(self, key) -> tuple[int, int]:
+        if isinstance(key, str):
+            return self.rows[self.index_by_sequence_id[key]]
+        return self.rows[self.indices[key]]
+
+    def get_field(self, name: str, key):
+        """
+        One field of one sample, by position in this view or by sequence_id. Arrays are views into the memory-mapped
+        shard, copy them before modifying.
+        """
+        shard, row = self.get_row(key)
+        if name in self.ragged_columns:
+            return self.get_ragged(name, shard, row)
+        return self.columns[name][shard][row]
+
+    def get_ragged(self, name: str, shard: int, row: int) -> np.ndarray:
+        values, offsets = self.ragged_columns[name]
+        start, end = offsets[shard][row], offsets[shard][row + 1]
+        if values[shard] is None:
+            return self.get_file(shard)[name]["values"][start:end]
+        return values[shard][start:end]
+
+    def get_file(self, shard: int) -> h5py.File:
+        """h5py handle of a shard opened by this process, handles inherited from another process are never used."""
+        if self.pid != os.getpid():
+            # forked, the handles belong to the parent
+            self.files = {}
+            self.pid = os.getpid()
+        if shard not in self.files:
+            self.files[shard] = h5py.File(os.path.join(self.dataset_dir, self.shards[shard]), "r")
+        return self.files[shard]
+
+    def column(self, name: str):
+        """
+        The field of all samples of this view, an array for per-sample values, a RaggedColumn of memory-mapped
+        arrays otherwise.
+        """
+        if name in self.ragged_columns:
+            return RaggedColumn(self, name, self.rows[self.indices])
+        # samples are numbered shard by shard
+        return np.concatenate(self.columns[name])[self.indices]
+
+    def select(self, indices) -> "RouteDataset":
+        """View of some samples of this view, sharing the memory maps and the handles opened so far."""
+        view = object.__new__(RouteDataset)
+        view.__dict__.update(self.__dict__)
+        view.indices = self.indices[np.asarray(indices, dtype=np.int64)]
+        return view
+
+    def shuffled(self, seed=None) -> "RouteDataset":
+        return self.select(np.random.default_rng(seed).permutation(len(self)))
+
+    def split(self, num_parts: int, part: int) -> "RouteDataset":
+        """Every num_parts-th sample starting at part, e.g. the share of one of num_parts DataLoader workers."""
+        return self.select(np.arange(part, len(self), num_parts))
+
+    def close(self):
+        if self.pid == os.getpid():
+            for f in self.files.values():
+                f.close()
+        self.files = {}
+
+    def __enter__(self) -> "RouteDataset":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,130 @@
+import numpy as np
+import shapely
+
+
+class RouteGraph:
+    def __init__(self, node_ids, indptr, neighbors, edge_lengths, coords, coord_offsets):
+        """
+        Compact array-backed road graph for the route search. Nodes are integer indices, the outgoing edges of node i
+        are indptr[i]:indptr[i + 1] in CSR layout. The geometry of all edges is one (N, 2) coordinate buffer, edge e
+        spans coords[coord_offsets[e]:coord_offsets[e + 1]].
+        :param node_ids: Tree node id of every node index
+        :param indptr: (num_nodes + 1,) start of the outgoing edges of each node
+        :param neighbors: (num_edges,) end node index of each edge
+        :param edge_lengths: (num_edges,) length of each edge in m
+        """
+        self.node_ids = node_ids
+        self.node_index = {node_id: i for i, node_id in enumerate(node_ids)}
+        self.indptr = indptr
+        self.neighbors = neighbors
+        self.edge_lengths = edge_lengths
+        self.coords = coords
+        self.coord_offsets = coord_offsets
+
+    @classmethod
+    def from_tree(cls, tree) -> "RouteGraph":
+        """Compiles the nodes and connections of a Tree, edges keep the order of the connections of each node."""
+        node_ids = list(tree.nodes)
+        node_index = {node_id: i for i, node_id in enumerate(node_ids)}
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        neighbors = []
+        geometries = []
+        for i, node in enumerate(tree.nodes.values()):
+            for next_node_id, connection in node.get_connections().items():
+                neighbors.append(node_index[next_node_id])
+                geometries.append(connection)
+            indptr[i + 1] = len(neighbors)
+
+        geometries = np.array(geometries, dtype=object)
+        coords, edge_index = shapely.get_coordinates(geometries, return_index=True)
+        coord_offsets = np.zeros(len(geometries) + 1, dtype=np.int64)
+        coord_offsets[1:] = np.cumsum(np.bincount(edge_index, minlength=len(geometries)))
+        return cls(
+            node_ids,
+            indptr,
+            np.array(neighbors, dtype=np.int64),
+            shapely.length(geometries).astype(np.float64),
+            coords,
+            coord_offsets,
+        )
+
+    def iter_routes(self, start_nodes: list[int], horizon=200, max_expansions=None):
+        """
+        Lazily yields (edges, nodes) index lists for every path without repeated nodes that starts at one of
+        start_nodes and is at least horizon m long, in depth-first order. The path being explored is shared on an
+        explicit stack and only copied when a route is yielded.
+        :param max_expansions: Stop after following this many edges, None for no limit
+        """
+        # plain lists are faster than numpy arrays for scalar access
+        indptr = self.indptr.tolist()
+        neighbors = self.neighbors.tolist()
+        edge_lengths = self.edge_lengths.tolist()
+        visited = bytearray(len(self.node_ids))
+        expansions = 0
+        for start_node in start_nodes:
+            if horizon <= 0:
+                yield [], [start_node]
+                continue
+            edges = []
+            nodes = [start_node]
+            route_lengths = [0.0]
+            visited[start_node] = 1
+            # next edge to explore for every node on the current path
+            next_edges = [indptr[start_node]]
+            while next_edges:
+                node = nodes[-1]
+                edge = next_edges[-1]
+                if edge == indptr[node + 1]:
+                    # all edges of the last node are explored, step back
+                    next_edges.pop()
+                    visited[nodes.pop()] = 0
+                    route_lengths.pop()
+                    if edges:
+                        edges.pop()
+                    continue
+                next_edges[-1] += 1
+                next_node = neighbors[edge]
+                if visited[next_node]:
+                    continue
+                if max_expansions is not None and expansions >= max_expansions:
+                    print(f"Stopped route search after {max_expansions} expansions.")
+                    return
+                expansions += 1
+
+                route_length = route_lengths[-1] + edge_lengths[edge]
+                if route_length >= horizon:
+                    yield edges + [edge], nodes + [next_node]
+                else:
+                    edges.append(edge)
+                    nodes.append(next_node)
+                    route_lengths.append(route_length)
+                    visited[next_node] = 1
+                    next_edges.append(indptr[next_node])
+
+    def get_edge_coords(self, edge: int) -> np.ndarray:
+        return self.coords[self.coord_offsets[edge] : self.coord_offsets[edge + 1]]
+
+    def get_routes_coords(self, routes: list[list[int]]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Stitches the edges of every route into one polyline, consecutive edges share their end and start point.
+        Returns all polylines as one (N, 2) array and their offsets, route i spans coords[offsets[i]:offsets[i + 1]].
+        """
+        route_sizes = np.array([len(route) for route in routes], dtype=np.int64)
+        offsets = np.zeros(len(routes) + 1, dtype=np.int64)
+        if route_sizes.sum() == 0:
+            return np.empty((0, 2)), offsets
+        edges = np.concatenate([np.asarray(route, dtype=np.int64) for route in routes])
+        route_of_edge = np.repeat(np.arange(len(routes)), route_sizes)
+        is_first_edge = np.zeros(len(edges), dtype=bool)
+        is_first_edge[np.cumsum(route_sizes)[route_sizes > 0] - route_sizes[route_sizes > 0]] = True
+
+        # the first point of every edge but the first is the last point of the previous one
+        starts = self.coord_offsets[edges] + ~is_first_edge
+        counts = self.coord_offsets[edges + 1] - starts
+        # starts[k], starts[k] + 1, ... for counts[k] points of every edge k
+        coord_index = np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        offsets[1:] = np.cumsum(np.bincount(route_of_edge, weights=counts, minlength=len(routes)).astype(np.int64))
+        return self.coords[coord_index], offsets
+
+    def get_route_coords(self, route: list[int]) -> np.ndarray:
+        return self.get_routes_coords([route])[0]
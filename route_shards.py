@@ -0,0 +1,145 @@
+import json
+import os
+import uuid
+
+import h5py
+import numpy as np
+
+SHARD_VERSION = 1
+SHARD_SUFFIX = ".h5"
+INDEX_FILE = "index.json"
+# (N, 2) point columns, the other arrays are one value per time step
+COORD_COLUMNS = ["route_coords", "all_route_coords"]
+# small dicts with mixed types, stored as one JSON string per sample
+JSON_COLUMNS = ["route_properties"]
+
+
+def flatten_sample(sample: dict, prefix: str = "") -> dict:
+    """
+    Flattens a sample of create_data_samples into columns named by their path, e.g. "kinematics/oxts_lat".
+    Arrays become float32 (route coordinates (N, 2), map_data (N, 2) int64 node ids), numbers float64.
+    """
+    columns = {}
+    for key, value in sample.items():
+        name = prefix + key
+        if name in JSON_COLUMNS:
+            columns[name] = json.dumps(value, default=str)
+        elif isinstance(value, dict):
+            columns.update(flatten_sample(value, name + "/"))
+        elif isinstance(value, str):
+            columns[name] = value
+        elif name == "map_data":
+            columns[name] = np.array([[link_id.node_id_a, link_id.node_id_b] for link_id in value], dtype=np.int64)
+            columns[name] = columns[name].reshape(-1, 2)
+        elif isinstance(value, (list, tuple, np.ndarray)):
+            columns[name] = np.asarray(value, dtype=np.float32)
+            if name in COORD_COLUMNS:
+                columns[name] = columns[name].reshape(-1, 2)
+        else:
+            columns[name] = np.float64(value)
+    return columns
+
+
+def is_shard(file_name: str) -> bool:
+    return file_name.endswith(SHARD_SUFFIX)
+
+
+def list_shards(output_dir: str) -> list[str]:
+    """Finalized shards in the folder, shards still being written have a temporary name and are never listed."""
+    return sorted(file for file in os.listdir(output_dir) if is_shard(file))
+
+
+class ShardWriter:
+    def __init__(
+        self, output_dir: str, prefix: str = None, max_samples: int = 1024, compression: str = None, on_flush=None
+    ):
+        """
+        Appends samples to HDF5 shards of at most max_samples samples. Every column is stored with a fixed dtype,
+        arrays of all samples are concatenated into one "values" dataset with "offsets", sample i spans
+        values[offsets[i]:offsets[i + 1]]. The row of a sample in its shard is the position of its sequence_id.
+        A shard is written to a temporary file and renamed once complete, so readers never see partial shards.
+        :param prefix: Unique name of the writer, shards are named {prefix}-{number}.h5
+        :param compression: h5py compression filter for the arrays, e.g. "gzip" or "lzf", None to store them raw
+        :param on_flush: Called with the sequence_ids of every shard once it is renamed, i.e. once they are saved
+        """
+        self.output_dir = output_dir
+        self.prefix = prefix if prefix is not None else uuid.uuid4().hex[:12]
+        self.max_samples = max_samples
+        self.compression = compression
+        self.samples = []
+        self.num_shards = 0
+        self.finalized = []
+        self.on_flush = on_flush
+
+    def add_sample(self, sample: dict):
+        self.samples.append(flatten_sample(sample))
+        if len(self.samples) >= self.max_samples:
+            self.flush()
+
+    def flush(self) -> list[str]:
+        """Writes the buffered samples as one shard and returns their sequence_ids, does nothing if there are none."""
+        if not self.samples:
+            return []
+        shard_name = f"{self.prefix}-{self.num_shards:05d}{SHARD_SUFFIX}"
+        shard_path = os.path.join(self.output_dir, shard_name)
+        tmp_path = shard_path + ".tmp"
+        with h5py.File(tmp_path, "w") as f:
+            f.attrs["version"] = SHARD_VERSION
+            f.attrs["num_samples"] = len(self.samples)
+            for name in self.samples[0]:
+                self.write_column(f, name, [sample.get(name) for sample in self.samples])
+        os.replace(tmp_path, shard_path)
+        self.finalized.append(shard_name)
+        self.num_shards += 1
+        sequence_ids = [sample["sequence_id"] for sample in self.samples]
+        self.samples = []
+        if self.on_flush is not None:
+            self.on_flush(sequence_ids)
+        return sequence_ids
+
+    def write_column(self, f: h5py.File, name: str, values: list):
+        if any(value is None for value in values):
+            raise ValueError(f"Column {name} is missing in some samples of the shard")
+        if isinstance(values[0], str):
+            f.create_dataset(name, data=values, dtype=h5py.string_dtype())
+        elif isinstance(values[0], np.ndarray):
+            offsets = np.zeros(len(values) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(value) for value in values])
+            group = f.create_group(name)
+            group.attrs["ragged"] = True
+            group.create_dataset("values", data=np.concatenate(values), compression=self.compression)
+            group.create_dataset("offsets", data=offsets)
+        else:
+            f.create_dataset(name, data=np.array(values, dtype=np.float64))
+
+    def close(self) -> list[str]:
+        return self.flush()
+
+    def __enter__(self) -> "ShardWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_shard_sequence_ids(shard_path: str) -> list[str]:
+    with h5py.File(shard_path, "r") as f:
+        return [sequence_id.decode() for sequence_id in f["sequence_id"][()]]
+
+
+def build_index(output_dir: str) -> dict:
+    """
+    Writes index.json mapping every sequence_id to (shard, row) over all finalized shards of the folder and returns
+    it. If a sequence_id is in several shards, the first shard in name order wins.
+    """
+    shards = list_shards(output_dir)
+    sequence_ids = {}
+    for shard_number, shard in enumerate(shards):
+        for row, sequence_id in enumerate(read_shard_sequence_ids(os.path.join(output_dir, shard))):
+            sequence_ids.setdefault(sequence_id, [shard_number, row])
+    index = {"version": SHARD_VERSION, "shards": shards, "sequence_ids": sequence_ids}
+    tmp_path = os.path.join(output_dir, INDEX_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(output_dir, INDEX_FILE))
+    return index
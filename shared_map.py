@@ -0,0 +1,175 @@
+import json
+import sys
+from math import floor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import shapely
+
+from enums import MapObjectId
+from osm_wrapper import GeoRectangle, Link, graph_to_arrays, load_map_graph, project_to_utm
+
+# grid cell size of the spatial index in degrees, about 100 m
+INDEX_CELL_SIZE_DEG = 0.001
+# cell (i, j) is stored as the single key i * INDEX_KEY_FACTOR + j
+INDEX_KEY_FACTOR = 1 << 32
+
+
+def cell_range(lower: float, upper: float) -> tuple[int, int]:
+    return floor(lower / INDEX_CELL_SIZE_DEG), floor(upper / INDEX_CELL_SIZE_DEG)
+
+
+def build_grid_index(coords: np.ndarray, offsets: np.ndarray) -> dict:
+    """
+    Grid index of the edges as flat arrays, the edges with a bounding box overlapping the cell with key
+    cell_keys[k] are cell_edges[cell_offsets[k]:cell_offsets[k + 1]].
+    """
+    num_edges = len(offsets) - 1
+    cells = np.floor(coords / INDEX_CELL_SIZE_DEG).astype(np.int64)
+    lower = np.minimum.reduceat(cells, offsets[:-1], axis=0) if num_edges else np.empty((0, 2), dtype=np.int64)
+    upper = np.maximum.reduceat(cells, offsets[:-1], axis=0) if num_edges else np.empty((0, 2), dtype=np.int64)
+    sizes = upper - lower + 1
+    counts = sizes[:, 0] * sizes[:, 1]
+
+    # enumerate all cells of the bounding box of every edge
+    edges = np.repeat(np.arange(num_edges), counts)
+    position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    lat_cells = lower[edges, 0] + position // sizes[edges, 1]
+    lon_cells = lower[edges, 1] + position % sizes[edges, 1]
+    keys = lat_cells * INDEX_KEY_FACTOR + lon_cells
+
+    order = np.argsort(keys, kind="stable")
+    cell_keys, cell_counts = np.unique(keys[order], return_counts=True)
+    cell_offsets = np.zeros(len(cell_keys) + 1, dtype=np.int64)
+    cell_offsets[1:] = np.cumsum(cell_counts)
+    return {"cell_keys": cell_keys, "cell_offsets": cell_offsets, "cell_edges": edges[order]}
+
+
+def map_arrays_from_file(map_file: str) -> dict:
+    """
+    graph_to_arrays of a local extract with the attributes encoded per edge, the UTM points of the edges and a grid
+    index, everything a SharedLinkStore needs.
+    """
+    graph = load_map_graph(map_file)
+    arrays = graph_to_arrays(graph)
+    attributes = [json.dumps(data).encode() for data in json.loads(arrays.pop("attributes").tobytes().decode())]
+    arrays["attributes"] = np.frombuffer(b"".join(attributes), dtype=np.uint8)
+    arrays["attribute_offsets"] = np.zeros(len(attributes) + 1, dtype=np.int64)
+    arrays["attribute_offsets"][1:] = np.cumsum([len(data) for data in attributes])
+    arrays["metric_coords"], arrays["zone_numbers"], arrays["zone_letters"] = project_to_utm(
+        arrays["coords"], arrays["offsets"]
+    )
+    arrays.update(build_grid_index(arrays["coords"], arrays["offsets"]))
+    return arrays
+
+
+class SharedMap:
+    def __init__(self, segments: dict[str, shared_memory.SharedMemory], spec: dict):
+        """
+        Flat map arrays in shared memory. The process that loads the map creates them once, every other process
+        attaches to them by spec without copying, see create and attach.
+        :param spec: name -> (shared memory name, dtype, shape) of every array, small enough to send to workers
+        """
+        self.segments = segments
+        self.spec = spec
+        self.arrays = {}
+        for name, (_, dtype, shape) in spec.items():
+            array = np.ndarray(shape, dtype=dtype, buffer=segments[name].buf)
+            array.flags.writeable = False
+            self.arrays[name] = array
+
+    @classmethod
+    def create(cls, arrays: dict[str, np.ndarray]) -> "SharedMap":
+        segments = {}
+        spec = {}
+        for name, array in arrays.items():
+            # shared memory can't be empty
+            segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+            segments[name] = segment
+            spec[name] = (segment.name, array.dtype.str, array.shape)
+        return cls(segments, spec)
+
+    @classmethod
+    def attach(cls, spec: dict) -> "SharedMap":
+        return cls({name: attach_segment(segment) for name, (segment, _, _) in spec.items()}, spec)
+
+    def close(self):
+        """Detaches this process, the arrays must not be used anymore."""
+        self.arrays = {}
+        for segment in self.segments.values():
+            segment.close()
+
+    def unlink(self):
+        """Frees the shared memory, called once by the process that created it after all others are done."""
+        for segment in self.segments.values():
+            if sys.version_info < (3, 13):
+                # a worker sharing the resource tracker of this process may have unregistered the segment in attach
+                resource_tracker.register(segment._name, "shared_memory")
+            segment.unlink()
+
+
+def attach_segment(name: str) -> shared_memory.SharedMemory:
+    """
+    Attaches to a segment without tracking it, only the creating process unlinks it. Otherwise the resource tracker
+    of a worker unlinks it or warns about a leak when the worker exits.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    segment = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+class SharedLinkStore:
+    def __init__(self, shared_map: SharedMap):
+        """
+        LinkStore answering queries straight from the arrays of a SharedMap. Only the links of a query result are
+        created, so the memory of a process does not grow with the size of the region.
+        """
+        # the arrays are only valid as long as the shared memory is attached
+        self.shared_map = shared_map
+        self.arrays = shared_map.arrays
+
+    def __len__(self):
+        return len(self.arrays["u"])
+
+    def get_link(self, i: int, geometry) -> Link:
+        attribute_offsets = self.arrays["attribute_offsets"]
+        data = json.loads(self.arrays["attributes"][attribute_offsets[i] : attribute_offsets[i + 1]].tobytes())
+        data["geometry"] = geometry
+        link = Link(MapObjectId(int(self.arrays["u"][i]), int(self.arrays["v"][i])), data)
+        offsets = self.arrays["offsets"]
+        link.metric_coords = self.arrays["metric_coords"][offsets[i] : offsets[i + 1]]
+        link.utm_zone = (int(self.arrays["zone_numbers"][i]), str(self.arrays["zone_letters"][i]))
+        return link
+
+    def query(self, geo_rectangle: GeoRectangle) -> list[Link]:
+        """Returns the links intersecting the rectangle, in the order they were loaded, like LinkStore.query."""
+        rectangle = geo_rectangle.get_box()
+        min_lat, min_lon, max_lat, max_lon = rectangle.bounds
+        lat_cells = np.arange(*np.add(cell_range(min_lat, max_lat), [0, 1]), dtype=np.int64)
+        lon_cells = np.arange(*np.add(cell_range(min_lon, max_lon), [0, 1]), dtype=np.int64)
+        keys = (lat_cells[:, np.newaxis] * INDEX_KEY_FACTOR + lon_cells[np.newaxis, :]).ravel()
+
+        cell_keys = self.arrays["cell_keys"]
+        cell_offsets = self.arrays["cell_offsets"]
+        if len(cell_keys) == 0:
+            return []
+        positions = np.searchsorted(cell_keys, keys)
+        positions = positions[cell_keys[np.minimum(positions, len(cell_keys) - 1)] == keys]
+        if len(positions) == 0:
+            return []
+        candidates = np.unique(
+            np.concatenate([self.arrays["cell_edges"][cell_offsets[k] : cell_offsets[k + 1]] for k in positions])
+        )
+
+        # exact test on the candidate geometries only
+        offsets = self.arrays["offsets"]
+        counts = offsets[candidates + 1] - offsets[candidates]
+        point_index = np.repeat(offsets[candidates] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        geometries = shapely.linestrings(
+            self.arrays["coords"][point_index], indices=np.repeat(np.arange(len(candidates)), counts)
+        )
+        hits = shapely.intersects(geometries, rectangle)
+        return [self.get_link(i, geometry) for i, geometry in zip(candidates[hits], geometries[hits])]
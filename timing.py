@@ -0,0 +1,108 @@
+import json
+import math
+import os
+import time
+from contextlib import contextmanager
+
+# durations are counted in logarithmic bins, BINS_PER_OCTAVE bins per factor of two starting at MIN_DURATION seconds
+BINS_PER_OCTAVE = 4
+MIN_DURATION = 1e-6
+
+
+class StageTimer:
+    def __init__(self):
+        """
+        Wall time of the pipeline stages as a histogram per stage. Only a count, a sum, a maximum and one bin are
+        updated per measurement, and histograms of several processes can be merged exactly.
+        """
+        self.stages: dict[str, dict] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def iterate(self, name: str, iterable):
+        """Yields the items of iterable, the time to produce each item is counted for stage name."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def add(self, name: str, duration: float):
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = {"count": 0, "total": 0.0, "max": 0.0, "bins": {}}
+        stats["count"] += 1
+        stats["total"] += duration
+        stats["max"] = max(stats["max"], duration)
+        duration_bin = max(0, floor_log_bin(duration))
+        stats["bins"][duration_bin] = stats["bins"].get(duration_bin, 0) + 1
+
+    def pop_stats(self) -> dict:
+        """Returns the histograms measured so far and starts over, e.g. to send them from a worker to the parent."""
+        stages = self.stages
+        self.stages = {}
+        return stages
+
+    def merge(self, stages: dict):
+        for name, other in stages.items():
+            stats = self.stages.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0, "bins": {}})
+            stats["count"] += other["count"]
+            stats["total"] += other["total"]
+            stats["max"] = max(stats["max"], other["max"])
+            for duration_bin, count in other["bins"].items():
+                stats["bins"][duration_bin] = stats["bins"].get(duration_bin, 0) + count
+
+    def summary(self) -> dict:
+        """Count, total, mean, p50, p95, p99 and max in seconds per stage. Percentiles are exact to one bin."""
+        summary = {}
+        for name, stats in self.stages.items():
+            summary[name] = {
+                "count": stats["count"],
+                "total": stats["total"],
+                "mean": stats["total"] / stats["count"],
+                "p50": percentile(stats, 50),
+                "p95": percentile(stats, 95),
+                "p99": percentile(stats, 99),
+                "max": stats["max"],
+            }
+        return summary
+
+
+def floor_log_bin(duration: float) -> int:
+    if duration <= MIN_DURATION:
+        return 0
+    return math.floor(math.log2(duration / MIN_DURATION) * BINS_PER_OCTAVE)
+
+
+def percentile(stats: dict, q: float) -> float:
+    """Center of the bin holding the q-th percentile, never above the maximum."""
+    rank = q / 100 * stats["count"]
+    seen = 0
+    for duration_bin in sorted(stats["bins"]):
+        seen += stats["bins"][duration_bin]
+        if seen >= rank:
+            return min(MIN_DURATION * 2 ** ((duration_bin + 0.5) / BINS_PER_OCTAVE), stats["max"])
+    return stats["max"]
+
+
+def write_report(path: str, stage_timer: StageTimer, counters: dict, elapsed: float):
+    """Writes the stage summary and the counters as JSON, replacing the previous report at once."""
+    report = {"elapsed": elapsed, "counters": counters, "stages": stage_timer.summary()}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+# timer of this process
+timer = StageTimer()
@@ -1,13 +1,16 @@
+from math import ceil, floor, hypot
+
+import numpy as np
 import shapely
 from shapely import reverse
-from shapely.ops import split, linemerge
+from shapely.ops import linemerge, substring
 
 from shapely.geometry import LineString, Point
-from shapely.ops import nearest_points
 
 from enums import MapObjectId
 from osm_wrapper import OSMWrapper
-from utils import get_link_connecting_nodes, transform_to_vehicle_coordinates
+from route_graph import RouteGraph
+from utils import LocalGeometryCache, get_link_connecting_nodes, vehicle_to_vehicle_transform
 
 
 class Node:
@@ -25,15 +28,12 @@ class Node:
     def __repr__(self):
         return f"Node {self.node_id}"
 
-    def add_connection_from_map(self, node, wrapper, vehicle_data):
-        current_link_obj, reversed = get_link_connecting_nodes(self, node, wrapper)
+    def add_connection_from_map(self, node, wrapper, geometry_cache: LocalGeometryCache):
+        current_link_obj, reversed = get_link_connecting_nodes(self, node, wrapper, geometry_cache)
         if current_link_obj is None:
             print(f"Could not find link connecting {self.node_id} and {node.node_id}")
             return
-        link_in_local_coords = transform_to_vehicle_coordinates(vehicle_data, current_link_obj)
-        geometry_connection = LineString(link_in_local_coords)
-        if reversed:
-            geometry_connection = reverse(geometry_connection)
+        geometry_connection = geometry_cache.get(current_link_obj, reversed)
 
         self.connected_nodes[node.node_id] = geometry_connection
 
@@ -63,8 +63,18 @@ class Tree:
     def __init__(self, link_ids: list[MapObjectId], wrapper: OSMWrapper, vehicle_data: dict):
         self.link_ids = link_ids
         self.wrapper = wrapper
-        self.nodes: list[Node] = []
+        # id -> Node, the source of truth for the nodes of the tree
+        self.nodes: dict[str, Node] = {}
+        self.node_order: dict[str, int] = {}
+        self.start_node_ids: set[str] = set()
+        # grid cell -> ids of the nodes located in it, built by find_node_by_coords_close_by on first use
+        self.grid_size = 0.1
+        self.node_grid: dict[tuple[int, int], list[str]] = None
         self.vehicle_data = vehicle_data
+        # shared with get_route_properties, every link is transformed once per sample
+        self.geometry_cache = LocalGeometryCache(vehicle_data)
+        map_links = [link for link_id in self.link_ids for link in wrapper.get_sd_object_by_id(link_id)]
+        self.geometry_cache.add_links([link for link in map_links if not link.get_ID().is_loop()])
         for link_id in self.link_ids:
             if link_id.is_loop():
                 print(f"Link {link_id} is a loop, skipping.")
@@ -72,29 +82,134 @@ class Tree:
             node_1 = self.get_node(link_id.node_id_a)
             node_2 = self.get_node(link_id.node_id_b)
             if not node_1:
-                node_1 = Node(link_id.node_id_a)
-                self.nodes.append(node_1)
+                node_1 = self.add_node(Node(link_id.node_id_a))
             if not node_2:
-                node_2 = Node(link_id.node_id_b)
-                self.nodes.append(node_2)
+                node_2 = self.add_node(Node(link_id.node_id_b))
             # change later to see if bidirectional
-            node_1.add_connection_from_map(node_2, self.wrapper, self.vehicle_data)
-            node_2.add_connection_from_map(node_1, self.wrapper, self.vehicle_data)
+            node_1.add_connection_from_map(node_2, self.wrapper, self.geometry_cache)
+            node_2.add_connection_from_map(node_1, self.wrapper, self.geometry_cache)
+
+    def in_vehicle_frame(self, vehicle_data: dict, link_ids: list[MapObjectId] = None) -> "Tree":
+        """
+        Copy of the tree in the vehicle coordinate system of another ego pose, e.g. a later prediction time of the
+        same sequence. The map is not read again, all geometries are moved with one rigid transform. Nodes and
+        connections are added in the order of link_ids, like Tree(link_ids) does, so start points and capped route
+        searches find the same routes. The tree must not have start points yet, the copy has none either.
+        :param link_ids: Only keep the connections of these links, a subset of the links of the tree
+        """
+        if link_ids is None:
+            link_ids = self.link_ids
+        transform = vehicle_to_vehicle_transform(self.vehicle_data, vehicle_data)
+        if transform is None:
+            # the poses are in different UTM zones
+            return Tree(link_ids, self.wrapper, vehicle_data)
+        rotation, translation = transform
+
+        node_ids = {}
+        connections = {}
+        for link_id in link_ids:
+            if link_id.is_loop():
+                continue
+            node_id_a, node_id_b = str(link_id.node_id_a), str(link_id.node_id_b)
+            node_ids.setdefault(node_id_a)
+            node_ids.setdefault(node_id_b)
+            for node_id, next_node_id in [(node_id_a, node_id_b), (node_id_b, node_id_a)]:
+                connection = self.nodes[node_id].get_connections().get(next_node_id)
+                if connection is not None and (node_id, next_node_id) not in connections:
+                    connections[(node_id, next_node_id)] = connection
+        connections = [(*node_pair, connection) for node_pair, connection in connections.items()]
+        cache_keys = list(self.geometry_cache.geometries)
+        geometries = np.array(
+            [connection for _, _, connection in connections]
+            + [self.geometry_cache.geometries[key] for key in cache_keys],
+            dtype=object,
+        )
+        geometries = shapely.transform(geometries, lambda coords: coords @ rotation.T + translation)
+
+        tree = Tree.__new__(Tree)
+        tree.link_ids = link_ids
+        tree.wrapper = self.wrapper
+        tree.nodes = {node_id: Node(node_id) for node_id in node_ids}
+        tree.node_order = {node_id: i for i, node_id in enumerate(tree.nodes)}
+        tree.start_node_ids = set()
+        tree.grid_size = self.grid_size
+        tree.node_grid = None
+        tree.vehicle_data = vehicle_data
+        tree.geometry_cache = LocalGeometryCache(vehicle_data)
+        tree.geometry_cache.geometries = dict(zip(cache_keys, geometries[len(connections) :]))
+        for (node_id, next_node_id, _), geometry in zip(connections, geometries):
+            tree.nodes[node_id].connected_nodes[next_node_id] = geometry
+        return tree
+
+    def add_node(self, node: Node) -> Node:
+        self.node_order[node.node_id] = len(self.node_order)
+        self.nodes[node.node_id] = node
+        if node.start_point:
+            self.start_node_ids.add(node.node_id)
+        return node
+
+    def get_grid_cell(self, coords) -> tuple[int, int]:
+        return floor(coords[0] / self.grid_size), floor(coords[1] / self.grid_size)
+
+    def build_node_grid(self):
+        """Indexes the position of every node, nodes without connections have no position."""
+        self.node_grid = {}
+        for node in self.nodes.values():
+            if node.get_connections():
+                self.node_grid.setdefault(self.get_grid_cell(node.get_relative_coords()), []).append(node.node_id)
+
+    def set_start_node(self, node: Node):
+        node.start_point = True
+        self.start_node_ids.add(node.node_id)
 
     def get_node(self, node_id: str) -> Node:
         if type(node_id) == int:
             node_id = str(node_id)
-        node_list = [node for node in self.nodes if node.node_id == node_id]
-        if not node_list:
-            return None
-        return node_list[0]
+        return self.nodes.get(node_id)
 
     def get_start_nodes(self):
-        return [node for node in self.nodes if node.start_point == True]
+        # in the order the nodes were added, so routes are enumerated in a deterministic order
+        return [self.nodes[node_id] for node_id in sorted(self.start_node_ids, key=self.node_order.__getitem__)]
 
-    def insert_start_points(self, max_distance, iter):
+    def get_relevant_connections(self, max_distance, max_search_distance, step):
+        """
+        Returns (node, next_node_id, connection) for every road segment closer than max_distance to the ego vehicle,
+        every segment once in the direction it was first found. If there is none, the radius grows in steps of step m
+        up to max_search_distance until the nearest segment is included, answered with one spatial index query.
+        """
+        ego_in_local_coords = Point([0.0, 0.0])
+        segments = []
+        seen_pairs = set()
+        for node in self.nodes.values():
+            for next_node_id, connection in node.get_connections().items():
+                # connection is always from node to next_node
+                pair = frozenset([node.node_id, next_node_id])
+                if pair not in seen_pairs:
+                    seen_pairs.add(pair)
+                    segments.append((node, next_node_id, connection))
+        if not segments:
+            return []
+
+        geometries = [connection for _, _, connection in segments]
+        index = shapely.STRtree(geometries)
+        _, nearest_distances = index.query_nearest(ego_in_local_coords, return_distance=True)
+        nearest_distance = nearest_distances[0]
+        if nearest_distance >= max_search_distance:
+            return []
+        radius = max_distance
+        if nearest_distance >= max_distance:
+            # smallest radius of the sequence max_distance, max_distance + step, ... that includes the nearest segment
+            radius = max_distance + step * (floor((nearest_distance - max_distance) / step) + 1)
+            print(f"Expanded search radius to {radius} meters.")
+
+        candidates = np.sort(index.query(ego_in_local_coords, predicate="dwithin", distance=radius))
+        distances = shapely.distance(np.array(geometries, dtype=object)[candidates], ego_in_local_coords)
+        return [segments[i] for i, distance in zip(candidates, distances) if distance < radius]
+
+    def insert_start_points(self, max_distance, max_search_distance=1010, step=10):
         """
         Find connections (LineString) where any point is closer than max_distance to the ego vehicle, call it relevant_connections.
+        If there are none, use the connections within the smallest radius max_distance + k * step that contains any.
         Find the closest point on the link to the ego vehicle (so under max_distance), call it point X.
         For each relevant_connection, break the link at point X and insert a node at that point.
         Reassign the connections of the two broken links to the new node.
@@ -104,133 +219,107 @@ class Tree:
         connections_to_remove = []
         connections_to_add: list[tuple[Node, Node, Node, LineString, LineString]] = []
         inserted_node_id = 0
-        for node in self.nodes:
-            for next_node_id, connection in node.get_connections().items():
-                # connection is always from node to next_node
-                if (
-                    set([node.node_id, next_node_id]) not in connections_to_remove
-                    and connection.distance(ego_in_local_coords) < max_distance
-                ):  # not yet broken and relevant
-                    closest_point = nearest_points(connection, ego_in_local_coords)[0]
-                    buff = closest_point.buffer(
-                        0.01
-                    )  # https://stackoverflow.com/questions/50194077/shapely-unable-to-split-line-on-point-due-to-precision-issues
-                    try:
-                        first_seg, buff_seg, last_seg = split(connection, buff).geoms
-                    except ValueError:
-                        # continue
-                        # print(f"Could not split connection {connection} at point {closest_point}")
-                        # this means that the closest point is at the start or end of the line
-                        connection_start = connection.interpolate(0)
-                        connection_end = connection.interpolate(connection.length)
-                        if connection_start.distance(closest_point) < connection_end.distance(closest_point):
-                            # closest point is at the start
-                            node.start_point = True
-                        else:
-                            # closest point is at the end
-                            next_node = self.get_node(next_node_id)
-                            next_node.start_point = True
-                        continue
-                    connections_to_remove.append(set([node.node_id, next_node_id]))
-                    # make sure the linestring is connected by changing the last point of the first segment to the first point of the last segment
-                    new_first_seg = list(first_seg.coords)[:-1]
-                    new_first_seg.append(list(last_seg.coords)[0])
-                    first_seg = LineString(new_first_seg)
-                    # create new node
-                    new_node = Node(f"inserted_node_{inserted_node_id}", start_point=True)
-                    inserted_node_id += 1
-                    # add new node to the tree
-                    # add new connections
-                    next_node = self.get_node(next_node_id)
-                    connections_to_add.append([node, new_node, next_node, first_seg, last_seg])
+        for node, next_node_id, connection in self.get_relevant_connections(max_distance, max_search_distance, step):
+            # linear referencing, the distance along the connection of the point closest to the ego vehicle
+            split_distance = connection.project(ego_in_local_coords)
+            if split_distance <= 0.01 or split_distance >= connection.length - 0.01:
+                # the closest point is at the start or end of the line
+                if split_distance < connection.length - split_distance:
+                    # closest point is at the start
+                    self.set_start_node(node)
+                else:
+                    # closest point is at the end
+                    self.set_start_node(self.get_node(next_node_id))
+                continue
+            connections_to_remove.append((node.node_id, next_node_id))
+            first_seg = substring(connection, 0, split_distance)
+            last_seg = substring(connection, split_distance, connection.length)
+            # make sure the linestring is connected by changing the last point of the first segment to the first point of the last segment
+            new_first_seg = list(first_seg.coords)[:-1]
+            new_first_seg.append(list(last_seg.coords)[0])
+            first_seg = LineString(new_first_seg)
+            # create new node
+            new_node = Node(f"inserted_node_{inserted_node_id}", start_point=True)
+            inserted_node_id += 1
+            # add new connections
+            next_node = self.get_node(next_node_id)
+            connections_to_add.append([node, new_node, next_node, first_seg, last_seg])
 
         # remove the connections that were broken
-        for connection in connections_to_remove:
-            node_1 = self.get_node(list(connection)[0])
-            node_2 = self.get_node(list(connection)[1])
-            node_1.remove_connection(node_2.node_id)
-            node_2.remove_connection(node_1.node_id)
+        for node_id_1, node_id_2 in connections_to_remove:
+            self.get_node(node_id_1).remove_connection(node_id_2)
+            self.get_node(node_id_2).remove_connection(node_id_1)
 
         for node, new_node, next_node, first_seg, last_seg in connections_to_add:
-            self.nodes.append(new_node)
+            self.add_node(new_node)
             node.add_custom_connection(new_node, first_seg, self.vehicle_data, self.wrapper)
             new_node.add_custom_connection(node, reverse(first_seg), self.vehicle_data, self.wrapper)
             new_node.add_custom_connection(next_node, last_seg, self.vehicle_data, self.wrapper)
             next_node.add_custom_connection(new_node, reverse(last_seg), self.vehicle_data, self.wrapper)
+        # the nodes changed, the grid is rebuilt on the next lookup
+        self.node_grid = None
 
-        if len(self.get_start_nodes()) == 0 and iter < 100:  # try to get any route, even if it is bad
-            iter += 1
-            self.insert_start_points(max_distance + 10, iter)
-            if iter % 10 == 0:
-                print(f"Expanded search radius to {max_distance+10} meters.")
-
-    def find_possible_routes(self):
+    def find_possible_routes(self, horizon=200, max_routes=None, max_expansions=None):
+        """
+        Stores every route of at least horizon m from any start node, see iter_routes. Routes are lists of edge
+        indices into self.graph.
+        :param max_routes: Stop after this many routes, None for no limit
+        :param max_expansions: Stop after following this many connections, None for no limit
+        """
         self.routes = []
+        # ids of the nodes along each route, including the start and the end node
+        self.route_node_ids = []
         self.visited_nodes_per_route = []
-        for start_node in self.get_start_nodes():
-            visited = set([start_node.node_id])
-            self.explore_routes([], start_node, visited, 0)
+        for route, node_ids in self.iter_routes(horizon, max_expansions):
+            if max_routes is not None and len(self.routes) >= max_routes:
+                print(f"Stopped route search after {max_routes} routes.")
+                break
+            self.routes.append(route)
+            self.route_node_ids.append(node_ids)
+            self.visited_nodes_per_route.append(set(node_ids))
         # print("Routes found:", self.routes)
 
-    def explore_routes(self, current_route, current_node, visited, total_route_length):
-        if total_route_length >= 200:
-            self.routes.append(current_route)
-            self.visited_nodes_per_route.append(visited)
-            return
-        for next_node_id, connection in current_node.get_connections().items():
-            if next_node_id not in visited:
-                new_route = current_route.copy()
-                new_route.append(connection)
-                new_total_route_length = total_route_length + connection.length
-                next_node = self.get_node(next_node_id)
-                new_visited = visited.copy()
-                new_visited.add(next_node_id)
-                self.explore_routes(new_route, next_node, new_visited, new_total_route_length)
+    def iter_routes(self, horizon=200, max_expansions=None):
+        """
+        Lazily yields (edges, node_ids) for every path without repeated nodes that starts at a start node and
+        is at least horizon m long, in depth-first order. The search runs on a RouteGraph compiled from the current
+        nodes and connections, edges are indices into self.graph.
+        :param max_expansions: Stop after following this many connections, None for no limit
+        """
+        self.graph = RouteGraph.from_tree(self)
+        start_nodes = [self.graph.node_index[node.node_id] for node in self.get_start_nodes()]
+        for edges, nodes in self.graph.iter_routes(start_nodes, horizon, max_expansions):
+            yield edges, [self.graph.node_ids[node] for node in nodes]
+
+    def get_route_connections(self, route_index) -> list[LineString]:
+        node_ids = self.route_node_ids[route_index]
+        return [self.nodes[node_ids[i]].get_connections()[node_ids[i + 1]] for i in range(len(node_ids) - 1)]
 
     def get_routes_as_linestrings_2(self) -> list[tuple[Node, LineString]]:
         linestrings = []
-        for route in self.routes:
+        for i in range(len(self.routes)):
             linestring = LineString()
-            for node in route:
+            for node in self.get_route_connections(i):
                 linestring = linestring.union(node)
             linestrings.append(linemerge(linestring))
         return linestrings
 
-    def get_routes_as_linestrings(self) -> list[tuple[Node, LineString]]:
-        linestrings = []
-        for route in self.routes:
-            coords = []
-            for i, node in enumerate(route):
-                if i != 0:
-                    assert all(
-                        node.coords._coords[0] == coords[-1]
-                    ), f"Node {node.node_id} and {route[i-1].node_id} have different relative coordinates."
-                    coords.extend(node.coords._coords[1:])
-                else:
-                    coords.extend(node.coords._coords)
-            linestrings.append(LineString(coords))
+    def get_routes_as_coords(self) -> tuple[np.ndarray, np.ndarray]:
+        """All routes as one (N, 2) array and offsets, route i spans coords[offsets[i]:offsets[i + 1]]."""
+        return self.graph.get_routes_coords(self.routes)
 
-        return linestrings
+    def get_routes_as_linestrings(self) -> list[tuple[Node, LineString]]:
+        coords, offsets = self.get_routes_as_coords()
+        return [LineString(coords[offsets[i] : offsets[i + 1]]) for i in range(len(self.routes))]
 
     def get_routes_as_nodes(self) -> list[tuple[Node]]:
         """Only for debugging purposes."""
-        node_list = [[] for i in range(len(self.routes))]
-        for i, route in enumerate(self.routes):
-            for linestring in route:
-                start_point = linestring.coords[0]
-                node_list[i].append(self.find_node_by_coords_close_by(start_point))
-        return node_list
+        return [[self.nodes[node_id] for node_id in node_ids[:-1]] for node_ids in self.route_node_ids]
 
     def get_route_as_clean_nodes(self, route_index) -> list[tuple[Node]]:
         """Used to get properties of the best route. Clean means without inserted nodes."""
 
-        node_list = []
-        for linestring in self.routes[route_index]:
-            start_point = linestring.coords[0]
-            node_list.append(self.find_node_by_coords_close_by(start_point))
-        # append the end point
-        end_point = self.routes[route_index][-1].coords[-1]
-        node_list.append(self.find_node_by_coords_close_by(end_point))
+        node_list = [self.nodes[node_id] for node_id in self.route_node_ids[route_index]]
 
         # any link with inserted node has been broken to contain a start point
         # cure the link by removing the start point and adding the point on the other side of the inserted node
@@ -252,7 +341,7 @@ class Tree:
             else:
                 new_node_list.append(node)
         # determine distance along the line to the starting point of the resulting node list
-        start_point = Point(self.routes[route_index][0].coords[0])
+        start_point = Point(self.graph.get_edge_coords(self.routes[route_index][0])[0])
         connection = self.find_clean_connection_from_map(new_node_list[0], new_node_list[1])
         distance = shapely.line_locate_point(connection, start_point)
         assert (
@@ -261,21 +350,25 @@ class Tree:
         return new_node_list, distance
 
     def find_clean_connection_from_map(self, node_start, node_end):
-        current_link_obj, reversed = get_link_connecting_nodes(node_start, node_end, self.wrapper)
-        link_in_local_coords = transform_to_vehicle_coordinates(self.vehicle_data, current_link_obj)
-        geometry_connection = LineString(link_in_local_coords)
-        if reversed:
-            geometry_connection = reverse(geometry_connection)
-        return geometry_connection
+        current_link_obj, reversed = get_link_connecting_nodes(node_start, node_end, self.wrapper, self.geometry_cache)
+        return self.geometry_cache.get(current_link_obj, reversed)
 
     def find_node_by_coords_close_by(self, coords, max_distance=0.1):
+        """Returns the node closest to coords if it is closer than max_distance, only nearby grid cells are searched."""
+        if self.node_grid is None:
+            self.build_node_grid()
         closest_node = None
         closest_distance = float("inf")
-        for node in self.nodes:
-            distance = Point(node.get_relative_coords()).distance(Point(coords))
-            if distance < closest_distance:
-                closest_distance = distance
-                closest_node = node
+        cell_x, cell_y = self.get_grid_cell(coords)
+        cell_reach = ceil(max_distance / self.grid_size)
+        for x in range(cell_x - cell_reach, cell_x + cell_reach + 1):
+            for y in range(cell_y - cell_reach, cell_y + cell_reach + 1):
+                for node_id in self.node_grid.get((x, y), []):
+                    node_coords = self.nodes[node_id].get_relative_coords()
+                    distance = hypot(node_coords[0] - coords[0], node_coords[1] - coords[1])
+                    if distance < closest_distance:
+                        closest_distance = distance
+                        closest_node = self.nodes[node_id]
         if closest_distance < max_distance:
             return closest_node
 
@@ -284,7 +377,7 @@ class Tree:
         Make sure that each connection goes both ways.
 
         """
-        for node in self.nodes:
+        for node in self.nodes.values():
             for next_node_id, connection in node.get_connections().items():
                 next_node = self.get_node(next_node_id)
                 if node.node_id not in next_node.get_connections():
@@ -3,6 +3,7 @@ from typing import Tuple
 import utm
 
 import numpy as np
+import shapely
 from shapely.geometry import LineString
 from shapely.geometry import Point as ShapelyPoint
 
@@ -12,66 +13,192 @@ from enums import MapObjectId
 from osm_wrapper import Link
 
 
-def global_to_vehicle_coordinates(lcm_points, oxts_latlon, oxts_heading):
-    origin_x, origin_y, utm_zone_num, utm_zone_letter = utm.from_latlon(oxts_latlon[0], oxts_latlon[1])
-    origin = ShapelyPoint(origin_x, origin_y)
-    aft_origin = ShapelyPoint(0, 0)
-    rot_pts = []
+def latlon_to_vehicle_coordinates(latlon, ego_lat, ego_lon, ego_yaw) -> np.ndarray:
+    """
+    Transforms (N, 2) latitude/longitude points into the vehicle coordinate system in one vectorized pass.
+    The points are projected into the UTM zone of the ego vehicle, translated and rotated by ego_yaw (degrees).
+    """
+    latlon = np.asarray(latlon, dtype=np.float64).reshape(-1, 2)
+    origin_x, origin_y, utm_zone_num, utm_zone_letter = utm.from_latlon(ego_lat, ego_lon)
+    if len(latlon) == 0:
+        return np.empty((0, 2))
+    x, y, _, _ = utm.from_latlon(latlon[:, 0], latlon[:, 1], utm_zone_num, utm_zone_letter)
+
+    # Homogeneous transformation -> translate, rotate
+    return rotate_points(np.stack([x - origin_x, y - origin_y], axis=1), ego_yaw)
+
 
-    pts = np.array(
+def latlon_to_vehicle_coordinates_per_pose(latlon, pose_index, ego_lats, ego_lons, ego_yaws) -> np.ndarray:
+    """
+    latlon_to_vehicle_coordinates for the points of many ego poses at once, point i belongs to pose pose_index[i].
+    The points of all poses in the same UTM zone are projected with one call.
+    """
+    latlon = np.asarray(latlon, dtype=np.float64).reshape(-1, 2)
+    pose_index = np.asarray(pose_index, dtype=np.int64)
+    ego_lats = np.asarray(ego_lats, dtype=np.float64)
+    ego_lons = np.asarray(ego_lons, dtype=np.float64)
+    ego_yaws = np.asarray(ego_yaws, dtype=np.float64)
+    zone_ids = {}
+    pose_zone = np.array(
         [
-            utm.from_latlon(
-                shapepoint[0],
-                shapepoint[1],
-                utm_zone_num,
-                utm_zone_letter,
-            )[:2]
-            for shapepoint in lcm_points
-        ]
+            zone_ids.setdefault((utm.latlon_to_zone_number(lat, lon), utm.latitude_to_zone_letter(lat)), len(zone_ids))
+            for lat, lon in zip(ego_lats, ego_lons)
+        ],
+        dtype=np.int64,
     )
 
-    inverse_origin = [-origin.x, -origin.y]
+    local = np.empty((len(latlon), 2))
+    for (zone_number, zone_letter), zone_id in zone_ids.items():
+        points = np.flatnonzero(pose_zone[pose_index] == zone_id)
+        if len(points) == 0:
+            continue
+        poses = pose_index[points]
+        origin_x, origin_y, _, _ = utm.from_latlon(ego_lats, ego_lons, zone_number, zone_letter)
+        x, y, _, _ = utm.from_latlon(latlon[points, 0], latlon[points, 1], zone_number, zone_letter)
+        angle = np.deg2rad(ego_yaws[poses])
+        dx = x - origin_x[poses]
+        dy = y - origin_y[poses]
+        local[points, 0] = np.cos(angle) * dx - np.sin(angle) * dy
+        local[points, 1] = np.sin(angle) * dx + np.cos(angle) * dy
+    return local
+
+
+def rotate_points(points: np.ndarray, angle) -> np.ndarray:
+    """Vectorized version of rotate for (N, 2) points around the origin, angle in degrees."""
+    cos_angle = math.cos(np.deg2rad(angle))
+    sin_angle = math.sin(np.deg2rad(angle))
+    return np.stack(
+        [cos_angle * points[:, 0] - sin_angle * points[:, 1], sin_angle * points[:, 0] + cos_angle * points[:, 1]],
+        axis=1,
+    )
+
+
+def vehicle_to_vehicle_transform(from_vehicle_data: dict, to_vehicle_data: dict):
+    """
+    Rigid transform from the vehicle coordinate system of one ego pose to that of another, as a (2, 2) rotation and a
+    translation with to_points = from_points @ rotation.T + translation. None if the poses are in different UTM zones,
+    the projections differ then and points have to be transformed from latitude, longitude again.
+    """
+    from_x, from_y, from_zone_num, from_zone_letter = utm.from_latlon(
+        from_vehicle_data["ego_vehicle_lat"], from_vehicle_data["ego_vehicle_lon"]
+    )
+    to_x, to_y, to_zone_num, to_zone_letter = utm.from_latlon(
+        to_vehicle_data["ego_vehicle_lat"], to_vehicle_data["ego_vehicle_lon"]
+    )
+    if (from_zone_num, from_zone_letter) != (to_zone_num, to_zone_letter):
+        return None
+    # undo the rotation of the first pose, move to the second pose and rotate by its yaw
+    angle = np.deg2rad(to_vehicle_data["ego_vehicle_yaw"] - from_vehicle_data["ego_vehicle_yaw"])
+    rotation = np.array([[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]])
+    translation = rotate_points(np.array([[from_x - to_x, from_y - to_y]]), to_vehicle_data["ego_vehicle_yaw"])[0]
+    return rotation, translation
+
+
+def concatenate_link_coords(links) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the (latitude, longitude) points of all links as one (N, 2) array and the offsets of the links in it,
+    link i spans coords[offsets[i]:offsets[i + 1]].
+    """
+    coords, link_index = shapely.get_coordinates([link.get_geometry() for link in links], return_index=True)
+    offsets = np.zeros(len(links) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(link_index, minlength=len(links)))
+    return coords, offsets
+
+
+def links_to_vehicle_coordinates(links, vehicle_data) -> list[np.ndarray]:
+    """
+    Transforms many links at once, returns the local (N_i, 2) points of every link. Links projected by their store
+    are only translated and rotated, with one affine transform for all of them.
+    """
+    if not links:
+        return []
+    origin_x, origin_y, utm_zone_num, utm_zone_letter = utm.from_latlon(
+        vehicle_data["ego_vehicle_lat"], vehicle_data["ego_vehicle_lon"]
+    )
+    if all(link.utm_zone == (utm_zone_num, utm_zone_letter) for link in links):
+        metric_coords = np.concatenate([link.metric_coords for link in links])
+        local_coords = rotate_points(metric_coords - [origin_x, origin_y], vehicle_data["ego_vehicle_yaw"])
+        return np.split(local_coords, np.cumsum([len(link.metric_coords) for link in links])[:-1])
+
+    # links without UTM points, or in another zone than the ego vehicle
+    coords, offsets = concatenate_link_coords(links)
+    local_coords = latlon_to_vehicle_coordinates(
+        coords, vehicle_data["ego_vehicle_lat"], vehicle_data["ego_vehicle_lon"], vehicle_data["ego_vehicle_yaw"]
+    )
+    return np.split(local_coords, offsets[1:-1])
 
-    # Homogeneous transformation -> translate, rotate
-    for pt in pts:
-        point = translate(ShapelyPoint(pt), inverse_origin)
-        rot_pt = rotate(aft_origin, oxts_heading, point)
-        rot_pts.append([rot_pt.x, rot_pt.y])
 
-    return np.array(rot_pts)
+def interpolate_polylines(coords: np.ndarray, offsets: np.ndarray, distances: np.ndarray) -> np.ndarray:
+    """
+    Vectorized LineString.interpolate for many polylines of at least two points, stored as one (N, 2) array with
+    offsets, polyline i spans coords[offsets[i]:offsets[i + 1]]. Distances beyond the end give the last point.
+    Returns an (R, K, 2) array for R polylines and K distances.
+    """
+    starts = offsets[:-1]
+    ends = offsets[1:]
+    line_of_point = np.repeat(np.arange(len(starts)), ends - starts)
+    # segment k goes from point k to point k + 1, segments across two polylines are never selected
+    segment_lengths = np.hypot(*(coords[1:] - coords[:-1]).T)
+    cumulative = np.concatenate([[0.0], np.cumsum(segment_lengths)])
+    # distance of every point along its own polyline
+    along = cumulative - cumulative[starts][line_of_point]
+    line_lengths = along[ends - 1]
+    targets = np.minimum(distances[np.newaxis, :], line_lengths[:, np.newaxis])
+
+    # shifting every polyline by more than the longest length makes all of them searchable in one sorted array
+    line_shift = np.arange(len(starts)) * (line_lengths.max() + 1.0)
+    segment = np.searchsorted(along + line_shift[line_of_point], targets + line_shift[:, np.newaxis], side="right") - 1
+    segment = np.clip(segment, starts[:, np.newaxis], ends[:, np.newaxis] - 2)
+
+    fraction = np.divide(
+        targets - along[segment],
+        segment_lengths[segment],
+        out=np.zeros(targets.shape),
+        where=segment_lengths[segment] > 0,
+    )
+    return coords[segment] + fraction[..., np.newaxis] * (coords[segment + 1] - coords[segment])
+
+
+def global_to_vehicle_coordinates(lcm_points, oxts_latlon, oxts_heading):
+    return latlon_to_vehicle_coordinates(lcm_points, oxts_latlon[0], oxts_latlon[1], oxts_heading)
 
 
 def transform_to_vehicle_coordinates(vehicle_data, link):
     """Transforms the link points from lat lon to the vehicle coordinate system."""
-    ego_vehicle_lat = vehicle_data["ego_vehicle_lat"]
-    ego_vehicle_lon = vehicle_data["ego_vehicle_lon"]
-    ego_vehicle_yaw = vehicle_data["ego_vehicle_yaw"]
-    origin_x, origin_y, utm_zone_num, utm_zone_letter = utm.from_latlon(ego_vehicle_lat, ego_vehicle_lon)
-    origin = ShapelyPoint(origin_x, origin_y)
-    aft_origin = ShapelyPoint(0, 0)
-    rot_pts = []
-
+    if link.metric_coords is not None:
+        return links_to_vehicle_coordinates([link], vehicle_data)[0]
     lats, lons = link.get_geometry().coords.xy
-    pts = np.array(
-        [
-            utm.from_latlon(
-                lat,
-                lon,
-                utm_zone_num,
-                utm_zone_letter,
-            )[:2]
-            for lat, lon in zip(lats, lons)
-        ]
+    return latlon_to_vehicle_coordinates(
+        np.stack([lats, lons], axis=1),
+        vehicle_data["ego_vehicle_lat"],
+        vehicle_data["ego_vehicle_lon"],
+        vehicle_data["ego_vehicle_yaw"],
     )
 
-    inverse_origin = [-origin.x, -origin.y]
 
-    # Homogeneous transformation -> translate, rotate
-    for pt in pts:
-        point = translate(ShapelyPoint(pt), inverse_origin)
-        rot_pt = rotate(aft_origin, ego_vehicle_yaw, point)
-        rot_pts.append([rot_pt.x, rot_pt.y])
-    return rot_pts
+class LocalGeometryCache:
+    def __init__(self, vehicle_data: dict):
+        """
+        Link geometries in the vehicle coordinate system of one ego pose. Every link is transformed at most once per
+        sample, the reversed geometry is derived from the cached one.
+        """
+        self.vehicle_data = vehicle_data
+        self.geometries: dict[tuple[Link, bool], LineString] = {}
+
+    def add_links(self, links: list[Link]):
+        """Transforms all links that are not cached yet in one vectorized pass."""
+        new_links = [link for link in dict.fromkeys(links) if (link, False) not in self.geometries]
+        for link, local_coords in zip(new_links, links_to_vehicle_coordinates(new_links, self.vehicle_data)):
+            self.geometries[(link, False)] = LineString(local_coords)
+
+    def get(self, link: Link, reversed: bool = False) -> LineString:
+        """Returns the local geometry of the link, reversed if the link is traversed from its end node."""
+        if (link, reversed) not in self.geometries:
+            if reversed:
+                self.geometries[(link, True)] = shapely.reverse(self.get(link))
+            else:
+                self.geometries[(link, False)] = LineString(transform_to_vehicle_coordinates(self.vehicle_data, link))
+        return self.geometries[(link, reversed)]
 
 
 def transform_to_origin_coords(link):
@@ -116,54 +243,44 @@ def get_link_by_id(link_id, wrapper):
 
 
 def convert_shapepoint_to_vehicle_coords(shapepoint, vehicle_data):
-    ego_vehicle_lat = vehicle_data["ego_vehicle_lat"]
-    ego_vehicle_lon = vehicle_data["ego_vehicle_lon"]
-    ego_vehicle_yaw = vehicle_data["ego_vehicle_yaw"]
-    origin_x, origin_y, utm_zone_num, utm_zone_letter = utm.from_latlon(ego_vehicle_lat, ego_vehicle_lon)
-    origin = ShapelyPoint(origin_x, origin_y)
-    aft_origin = ShapelyPoint(0, 0)
-    pt = utm.from_latlon(
+    pt = [
         shapepoint.location.get_latitude().get_value_in_degrees().get_value(),
         shapepoint.location.get_longitude().get_value_in_degrees().get_value(),
-        utm_zone_num,
-        utm_zone_letter,
-    )[:2]
+    ]
+    rot_pt = latlon_to_vehicle_coordinates(
+        pt, vehicle_data["ego_vehicle_lat"], vehicle_data["ego_vehicle_lon"], vehicle_data["ego_vehicle_yaw"]
+    )[0]
+    return [rot_pt[0], rot_pt[1]]
 
-    inverse_origin = [-origin.x, -origin.y]
 
-    # Homogeneous transformation -> translate, rotate
-    point = translate(ShapelyPoint(pt), inverse_origin)
-    rot_pt = rotate(aft_origin, ego_vehicle_yaw, point)
-    return [rot_pt.x, rot_pt.y]
+def map_node_id(node_id):
+    """Returns the OSM id of a tree node, or None for nodes that were inserted into the tree and have no link."""
+    try:
+        return int(node_id)
+    except ValueError:
+        return None
 
 
-def get_link_connecting_nodes(node_1, node_2, wrapper) -> Tuple[Link, bool]:
+def get_link_connecting_nodes(node_1, node_2, wrapper, geometry_cache: LocalGeometryCache = None) -> Tuple[Link, bool]:
     """
     Returns the link connecting two nodes. if the link is stored as node_1-node_2, the second return value is False, otherwise True.
+    If several links connect the nodes, the shortest is returned, measured in geometry_cache if one is given.
     """
-    link_string_1 = f"{node_1.node_id}-{node_2.node_id}"
-    link_string_2 = f"{node_2.node_id}-{node_1.node_id}"
-    out = []
-    reversed_list = []
-    try:
-        l1_out = wrapper.get_sd_object_by_id(link_id_object(link_string_1))
-        out.extend(l1_out)
-        reversed_list.extend([False for i in range(len(l1_out))])
-    except:
-        pass
-    try:
-        l2_out = wrapper.get_sd_object_by_id(link_id_object(link_string_2))
-        out.extend(l2_out)
-        reversed_list.extend([True for i in range(len(l2_out))])
-    except:
-        pass
+    node_id_1 = map_node_id(node_1.node_id)
+    node_id_2 = map_node_id(node_2.node_id)
+    if node_id_1 is None or node_id_2 is None:
+        return None, None
+    out = wrapper.get_links_between(node_id_1, node_id_2)
 
     if len(out) == 1:
-        return out[0], reversed_list[0]
+        return out[0]
     elif len(out) > 1:
         # find shortest link
-        lengths = [LineString(transform_to_origin_coords(link)).length for link in out]
+        if geometry_cache is not None:
+            lengths = [geometry_cache.get(link).length for link, _ in out]
+        else:
+            lengths = [LineString(transform_to_origin_coords(link)).length for link, _ in out]
         best_index = np.argmin(lengths)
-        return out[best_index], reversed_list[best_index]
+        return out[best_index]
     else:
         return None, None